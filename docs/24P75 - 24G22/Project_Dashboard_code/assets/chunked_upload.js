@@ -0,0 +1,94 @@
+// Chunked, resumable upload of a CSV file to the dashboard server (see chunked_upload.py).
+// Dash loads every file in the assets folder, the function below is used by a clientside callback in dashboard.py.
+// The file is read from a file input and sent in pieces, so the browser never has to turn it into a base64 data URL.
+// Dash has no plain file input component, so the layout has an empty Div with the class chunked-upload-picker where the input
+// goes, and the input is added to it here whenever such a Div appears on the page.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    uploads: {
+        // Start uploading the file chosen in target.input into target.table and return its upload id and the attempt,
+        // which the dashboard polls for progress
+        start: function (n_clicks, target) {
+            const picker = document.getElementById(target.input);
+            const input = picker && picker.querySelector('input[type=file]');
+            if (!n_clicks || !input || !input.files.length) {
+                return window.dash_clientside.no_update;
+            }
+            const file = input.files[0];
+            const uploadId = uploadIdFor(target.table, file);
+            const attempt = Date.now().toString(36) + Math.random().toString(36).slice(2);
+            sendFile(uploadId, attempt, target.table, file).catch(function (error) {
+                fetch('/upload/' + uploadId + '/fail', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({message: 'The upload failed: ' + error.message})
+                });
+            });
+            return {upload_id: uploadId, attempt: attempt};
+        }
+    }
+});
+
+// The same file uploaded into the same table gets the same id, so an interrupted upload carries on where it stopped
+function uploadIdFor(table, file) {
+    const source = [table, file.name, file.size, file.lastModified].join('|');
+    let hash = 0x811c9dc5;
+    for (let i = 0; i < source.length; i++) {
+        hash ^= source.charCodeAt(i);
+        hash = Math.imul(hash, 0x01000193) >>> 0;
+    }
+    return table + '-' + hash.toString(16) + '-' + file.size;
+}
+
+async function requestJson(url, options) {
+    const response = await fetch(url, options);
+    const body = await response.json();
+    if (!response.ok) {
+        throw new Error(body.error || response.statusText);
+    }
+    return body;
+}
+
+async function sendFile(uploadId, attempt, table, file) {
+    let state = await requestJson('/upload/' + uploadId, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({table: table, filename: file.name, size: file.size, attempt: attempt})
+    });
+    const chunkSize = state.chunk_size;
+    let failures = 0;
+    while (state.received < file.size) {
+        const offset = state.received;
+        try {
+            state = await requestJson('/upload/' + uploadId + '?offset=' + offset, {
+                method: 'PUT',
+                headers: {'Content-Type': 'application/octet-stream'},
+                body: file.slice(offset, offset + chunkSize)
+            });
+            failures = 0;
+        } catch (error) {
+            // Wait a little longer after every failure in a row, then ask the server how much it has before trying again
+            failures += 1;
+            if (failures > 5) {
+                throw error;
+            }
+            await new Promise(function (resolve) { setTimeout(resolve, 1000 * 2 ** failures); });
+            state = await requestJson('/upload/' + uploadId);
+        }
+    }
+    await requestJson('/upload/' + uploadId + '/ingest', {method: 'POST'});
+}
+
+// Put a CSV file input in every picker Div that does not have one yet
+function addFileInputs() {
+    document.querySelectorAll('.chunked-upload-picker').forEach(function (picker) {
+        if (!picker.querySelector('input[type=file]')) {
+            const input = document.createElement('input');
+            input.type = 'file';
+            input.accept = '.csv';
+            picker.appendChild(input);
+        }
+    });
+}
+
+// The pages are rendered by Dash after the assets are loaded, so the pickers are filled in whenever the page changes
+new MutationObserver(addFileInputs).observe(document.documentElement, {childList: true, subtree: true});
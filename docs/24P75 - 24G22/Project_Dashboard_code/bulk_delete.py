@@ -0,0 +1,231 @@
+import re
+import threading
+import time
+
+from psycopg2 import sql
+
+from incremental_load import archived_columns, key_archive_table
+
+#Soft deletion of rows of homicide_news, many at a time.
+#Rows are chosen by article_id, as a list of ids and ranges ("12, 15-20, 31"), by a filter on the columns
+#("place_of_death_province = WC and date_of_death < 2015-01-01"), or by both, in which case a row has to match both.
+#Deleting a row sets its deleted_at and restoring it clears it again, each a single UPDATE, so both dashboards see the same
+#rows and a mistaken delete is undone without copying anything. Every query reading homicide_news keeps to the live rows with
+#deleted_at IS NULL, which is what the partial indexes created in main.py are built for.
+#Rows deleted more than purge_after_days ago are moved into delete_dash by purge_deleted, with an INSERT ... RETURNING feeding a
+#DELETE so only the rows that were archived leave homicide_news, and the table is vacuumed so the space they took is reused.
+#The rows in delete_dash are no longer restored from the dashboards, but incremental loads still know not to insert them again.
+
+archive_table = 'delete_dash'
+
+#Days a deleted row can still be restored before it is purged, how many rows are purged per transaction and how often, in
+#seconds, the purge job runs
+purge_after_days = 30
+purge_batch_size = 1000
+purge_interval = 6 * 60 * 60
+
+#Comparisons allowed in a filter and the SQL they stand for
+filter_operators = {
+    '=': '=', '!=': '<>', '<>': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+    'like': 'LIKE', 'not like': 'NOT LIKE', 'ilike': 'ILIKE', 'not ilike': 'NOT ILIKE'
+}
+
+_range_pattern = re.compile(r'^(\d+)-(\d+)$')
+_clause_pattern = re.compile(
+    r'\s*(\w+)\s*(<=|>=|!=|<>|=|<|>|(?:not\s+)?i?like\b|is\s+(?:not\s+)?empty\b)\s*(.*?)\s*', re.IGNORECASE | re.DOTALL
+)
+
+class DeleteError(Exception):
+    pass
+
+#The ids and (first, last) ranges in text like "12, 15-20, 31"
+def parse_ids(text):
+    ids = []
+    ranges = []
+    for token in re.split(r'[,;\s]+', re.sub(r'\s*-\s*', '-', (text or '').strip())):
+        if not token:
+            continue
+        if token.isdigit():
+            ids.append(int(token))
+            continue
+        match = _range_pattern.match(token)
+        if not match:
+            raise DeleteError(f"'{token}' is not an article_id or a range of them like 15-20.")
+        first, last = int(match.group(1)), int(match.group(2))
+        if first > last:
+            raise DeleteError(f"The range {token} ends before it starts.")
+        ranges.append((first, last))
+    return ids, ranges
+
+#The (column, operator, value) clauses of a filter like "race_of_victim = Unknown and age_of_victim > 90". Values may be quoted,
+#the operators are those of filter_operators plus "is empty" and "is not empty".
+def parse_filter(text, columns):
+    clauses = []
+    for clause in re.split(r'\s+and\s+', (text or '').strip(), flags=re.IGNORECASE):
+        if not clause:
+            continue
+        match = _clause_pattern.fullmatch(clause)
+        if not match:
+            raise DeleteError(f"Could not read '{clause}', write it as: column operator value.")
+        column, operator, value = match.group(1), ' '.join(match.group(2).lower().split()), match.group(3)
+        if column not in columns:
+            raise DeleteError(f"Column not found: {column}.")
+        if operator.startswith('is'):
+            if value:
+                raise DeleteError(f"'{operator}' does not take a value: {clause}.")
+        elif len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+            value = value[1:-1]
+        elif not value:
+            raise DeleteError(f"No value given in: {clause}.")
+        clauses.append((column, operator, value))
+    return clauses
+
+#WHERE condition selecting the rows to delete, from the ids and the filter typed on the Delete page
+def selection(cursor, ids='', where=''):
+    conditions = []
+    id_list, ranges = parse_ids(ids)
+    chosen = [sql.SQL("article_id BETWEEN {} AND {}").format(sql.Literal(first), sql.Literal(last)) for first, last in ranges]
+    if id_list:
+        chosen.insert(0, sql.SQL("article_id = ANY({})").format(sql.Literal(id_list)))
+    if chosen:
+        conditions.append(sql.SQL("({})").format(sql.SQL(' OR ').join(chosen)))
+
+    if (where or '').strip():
+        cursor.execute("""SELECT column_name FROM information_schema.columns
+                          WHERE table_schema = current_schema() AND table_name = 'homicide_news'""")
+        columns = {row[0] for row in cursor.fetchall()}
+        for column, operator, value in parse_filter(where, columns):
+            if operator == 'is empty':
+                condition = sql.SQL("({0} IS NULL OR btrim({0}::text) = '')")
+            elif operator == 'is not empty':
+                condition = sql.SQL("btrim({0}::text) <> ''")
+            else:
+                condition = sql.SQL("{0} " + filter_operators[operator] + " {1}")
+            conditions.append(condition.format(sql.Identifier(column), sql.Literal(value)))
+
+    if not conditions:
+        raise DeleteError("Please enter the article_ids to delete, a filter, or both.")
+    return sql.SQL(' AND ').join(conditions)
+
+#Soft delete the live rows chosen by ids and where. Returns the number of rows deleted and the number of matching rows that
+#had already been deleted.
+def delete_records(connection, ids='', where=''):
+    with connection.cursor() as cursor:
+        condition = selection(cursor, ids, where)
+        # The second count reads the table as it was before the UPDATE, so it counts the rows deleted before
+        cursor.execute(sql.SQL("""
+            WITH deleted AS (
+                UPDATE homicide_news SET deleted_at = CURRENT_TIMESTAMP
+                WHERE {condition} AND deleted_at IS NULL
+                RETURNING article_id
+            )
+            SELECT (SELECT COUNT(*) FROM deleted),
+                   (SELECT COUNT(*) FROM homicide_news WHERE {condition} AND deleted_at IS NOT NULL)""").format(condition=condition))
+        deleted, already_deleted = cursor.fetchone()
+    connection.commit()
+    return deleted, already_deleted
+
+#Bring back the deleted rows chosen by ids and where that have not been purged yet. Returns the number of rows restored.
+def restore_records(connection, ids='', where=''):
+    with connection.cursor() as cursor:
+        condition = selection(cursor, ids, where)
+        cursor.execute(sql.SQL("UPDATE homicide_news SET deleted_at = NULL WHERE {condition} AND deleted_at IS NOT NULL").format(
+            condition=condition))
+        restored = cursor.rowcount
+    connection.commit()
+    return restored
+
+#The deleted rows that can still be restored, most recently deleted first
+deleted_rows_query = "SELECT * FROM homicide_news WHERE deleted_at IS NOT NULL ORDER BY deleted_at DESC, article_id"
+
+#One line describing the result of delete_records for the dashboards
+def delete_message(deleted, already_deleted):
+    if deleted == 0 and already_deleted == 0:
+        return "No records matched, nothing was deleted."
+    if deleted == 0:
+        return f"The {already_deleted} matching record(s) have already been deleted."
+    message = (f"{deleted} record(s) deleted. They can be restored for {purge_after_days} days, "
+               f"after that they are moved into the {archive_table} table.")
+    if already_deleted:
+        message += f" {already_deleted} other matching record(s) had been deleted before."
+    return message
+
+def restore_message(restored):
+    if restored == 0:
+        return "No deleted records matched, nothing was restored."
+    return f"{restored} record(s) restored."
+
+#Move the rows deleted more than older_than_days ago into delete_dash, purge_batch_size rows per transaction, and vacuum
+#homicide_news afterwards. Only one process purges at a time, the others return 0 straight away. Returns the number of rows moved.
+def purge_deleted(connection, older_than_days=purge_after_days):
+    purged = 0
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext('homicide_news_purge'))")
+        if not cursor.fetchone()[0]:
+            connection.commit()
+            return 0
+        try:
+            cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} (LIKE homicide_news INCLUDING ALL EXCLUDING GENERATED)").format(
+                sql.Identifier(archive_table)))
+            key_archive_table(cursor, archive_table)
+            columns = sql.SQL(', ').join(sql.Identifier(name) for name in archived_columns(cursor))
+            connection.commit()
+            # The batch is locked so it cannot be restored while it is archived, and a row is only deleted once it is in delete_dash
+            move_batch = sql.SQL("""
+                WITH batch AS (
+                    SELECT article_id FROM homicide_news
+                    WHERE deleted_at < CURRENT_TIMESTAMP - make_interval(days => %(days)s)
+                    ORDER BY deleted_at
+                    LIMIT %(batch_size)s
+                    FOR UPDATE
+                ),
+                archived AS (
+                    INSERT INTO {archive} ({columns})
+                    SELECT {columns} FROM homicide_news WHERE article_id IN (SELECT article_id FROM batch)
+                    RETURNING article_id
+                ),
+                moved AS (
+                    DELETE FROM homicide_news WHERE article_id IN (SELECT article_id FROM archived)
+                )
+                SELECT COUNT(*) FROM archived""").format(archive=sql.Identifier(archive_table), columns=columns)
+            while True:
+                cursor.execute(move_batch, {'days': older_than_days, 'batch_size': purge_batch_size})
+                moved = cursor.fetchone()[0]
+                connection.commit()
+                if moved == 0:
+                    break
+                purged += moved
+        finally:
+            connection.rollback()
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('homicide_news_purge'))")
+            connection.commit()
+
+    if purged:
+        # VACUUM cannot run inside a transaction. The connections of db.get_connection are SQLAlchemy pool proxies, where setting
+        # autocommit only sets an attribute of the proxy, so it is set on the psycopg2 connection underneath
+        dbapi_connection = getattr(connection, 'dbapi_connection', connection)
+        autocommit = dbapi_connection.autocommit
+        dbapi_connection.autocommit = True
+        try:
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute("VACUUM (ANALYZE) homicide_news")
+        finally:
+            dbapi_connection.autocommit = autocommit
+        print(f"{purged} deleted row(s) older than {older_than_days} days moved into {archive_table}.")
+    return purged
+
+#Run purge_deleted every interval seconds on a background thread. connect is a context manager giving a connection
+#(db.get_connection), on_done is called after every purge that moved rows.
+def start_purge_job(connect, interval=purge_interval, on_done=None):
+    def run():
+        while True:
+            try:
+                with connect() as conn:
+                    purged = purge_deleted(conn)
+                if purged and on_done is not None:
+                    on_done()
+            except Exception as error:
+                print(f"Error in purge_deleted: {error}")
+            time.sleep(interval)
+
+    threading.Thread(target=run, name="purge-deleted", daemon=True).start()
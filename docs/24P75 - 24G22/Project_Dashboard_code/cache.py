@@ -0,0 +1,165 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+#In-process cache for query results and figures.
+#Entries are evicted when the cache is full (least recently used first) or when they are older than ttl seconds,
+#and the whole cache is invalidated whenever the dashboard writes to the database.
+#When the dashboard is served by several worker processes (see serve.py) the cache is a SQLite file they all share instead, so an
+#aggregate or figure computed by one worker is served by all of them and a write through any worker invalidates it for all.
+
+#Environment variable holding the path of the shared cache file, set by serve.py for its workers
+shared_cache_variable = 'DASHBOARD_CACHE_PATH'
+
+#Returned by get when a key is not in the cache, so that None can be cached as well
+missing = object()
+
+#Turn the parts of a cache key (category, plot type, filters, ...) into one hashable string
+def make_key(*parts):
+    return json.dumps(parts, sort_keys=True, default=str)
+
+class ResultCache:
+    def __init__(self, max_entries=256, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a result computed before a write is never stored after it
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return missing
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return missing
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    #Return the cached value for key, or compute it, cache it and return it
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not missing:
+            return value
+        generation = self.generation()
+        value = compute()
+        self.set(key, value, generation)
+        return value
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    #Drop every entry, called after anything is written to the database
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+#The results cache in a SQLite file shared by every process that opens it. Values are pickled, entries expire after ttl seconds
+#of wall clock time and the ones closest to expiring are evicted when there are more than max_entries. The generation is kept
+#in the file as well, so a result computed before a write in another process is not stored after it either.
+class DiskCache(ResultCache):
+    def __init__(self, path, max_entries=256, ttl=600):
+        super().__init__(max_entries, ttl)
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)")
+            connection.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value INTEGER)")
+            connection.execute("INSERT OR IGNORE INTO state VALUES ('generation', 0)")
+
+    #One connection for each thread, in WAL mode so readers are never blocked by a writer in another process
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    #Expired entries are left where they are until the next set removes them, so reading never takes the write lock
+    def get(self, key):
+        row = self._connection().execute("SELECT value FROM entries WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return missing if row is None else pickle.loads(row[0])
+
+    def set(self, key, value, generation=None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._transaction() as connection:
+            if generation is not None and generation != self._stored_generation(connection):
+                return
+            now = time.time()
+            connection.execute("DELETE FROM entries WHERE expires < ?", (now,))
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, data, now + self.ttl))
+            connection.execute("""DELETE FROM entries WHERE key IN (
+                                      SELECT key FROM entries ORDER BY expires DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def _stored_generation(self, connection):
+        return connection.execute("SELECT value FROM state WHERE name = 'generation'").fetchone()[0]
+
+    def generation(self):
+        return self._stored_generation(self._connection())
+
+    def invalidate(self):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("UPDATE state SET value = value + 1 WHERE name = 'generation'")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM entries WHERE expires >= ?", (time.time(),)).fetchone()[0]
+
+#Runs a with block in one immediate SQLite transaction, rolled back if the block raises
+class _Transaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+#The results cache of the dashboard: a DiskCache when serve.py has set a shared cache file for its workers, otherwise one in
+#this process
+def create_cache(max_entries=256, ttl=600):
+    path = os.environ.get(shared_cache_variable)
+    if path:
+        return DiskCache(path, max_entries, ttl)
+    return ResultCache(max_entries, ttl)
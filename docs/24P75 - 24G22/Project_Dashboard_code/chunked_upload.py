@@ -0,0 +1,262 @@
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where serve.py runs a single process and a lock per upload between its threads is enough
+    fcntl = None
+
+import upload
+
+#Chunked, resumable uploads for the dashboard.
+#The browser sends the file in pieces of chunk_size bytes to /upload/<upload_id> (see assets/chunked_upload.js). Every piece is
+#appended to <upload_id>.part in upload_dir, so the server never holds more than one block of the file in memory, and an upload
+#that was interrupted carries on from the bytes already on disk when the same file is sent again. When the whole file is in, it
+#is copied into the table from disk by upload.copy_upload on a background thread. The state of every upload is kept in
+#<upload_id>.json next to the data, so the Dash callbacks only pass the upload_id around and poll it for progress.
+#Changes to the state of an upload are serialised by a lock on its <upload_id>.lock file, which holds between the worker
+#processes of serve.py as well as between threads, and only ever for that one upload. A piece is read from the network before
+#the lock is taken, so a slow client holds up nothing but its own upload.
+
+upload_dir = os.path.join(tempfile.gettempdir(), 'homicide_uploads')
+
+#Size of the pieces the browser sends, and of the blocks they are written to disk in
+chunk_size = 8 * 1024 * 1024
+write_block_size = 1024 * 1024
+
+#Largest file accepted
+max_upload_bytes = 2 * 1024 * 1024 * 1024
+
+#Uploads that have not been touched for this many seconds are removed
+stale_after = 24 * 60 * 60
+
+#How often, in seconds, the progress of a running ingest is written to its state file
+progress_interval = 1.0
+
+#upload ids are made by the browser from the table, the file name, size and modification time
+_upload_id_pattern = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+class UploadStateError(Exception):
+    pass
+
+def _path(upload_id, suffix):
+    if not _upload_id_pattern.match(upload_id or ''):
+        raise UploadStateError("Invalid upload id.")
+    return os.path.join(upload_dir, upload_id + suffix)
+
+#Hold the lock of one upload for the duration of a with block
+@contextmanager
+def _locked(upload_id):
+    os.makedirs(upload_dir, exist_ok=True)
+    path = _path(upload_id, '.lock')
+    with open(path, 'a') as lock_file:
+        # touched so remove_stale_uploads leaves the lock of an upload alone for as long as it is in use
+        os.utime(path)
+        if fcntl is None:
+            with _thread_locks_lock:
+                lock = _thread_locks.setdefault(upload_id, threading.Lock())
+            with lock:
+                yield
+            return
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _write_state(upload_id, state):
+    state['updated'] = time.time()
+    path = _path(upload_id, '.json')
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(path + '.tmp', path)
+
+#State of an upload: table, filename, size, received bytes, status ('receiving', 'ingesting', 'done' or 'failed'),
+#ingested bytes, the message of the result, the number of problems in the rejects report and the attempt (a token from the
+#browser for each press of the Upload button, so the progress of a new attempt is not confused with the result of the last
+#one). None when there is no such upload.
+def read_state(upload_id):
+    try:
+        with open(_path(upload_id, '.json')) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+#Start an upload, or pick up the one with the same id that was interrupted. Returns its state.
+def start_upload(upload_id, table, filename, size, attempt=''):
+    if table not in upload.upload_tables:
+        raise UploadStateError(f"Uploads into {table} are not allowed.")
+    if not 0 < size <= max_upload_bytes:
+        raise UploadStateError(f"Files must be between 1 byte and {max_upload_bytes // (1024 * 1024)} MB.")
+    os.makedirs(upload_dir, exist_ok=True)
+    remove_stale_uploads()
+    with _locked(upload_id):
+        state = read_state(upload_id)
+        if state and state['status'] == 'receiving' and state['table'] == table and state['size'] == size:
+            part = _path(upload_id, '.part')
+            state['received'] = os.path.getsize(part) if os.path.exists(part) else 0
+            state['attempt'] = attempt
+            _write_state(upload_id, state)
+            return state
+        if state and state['status'] == 'ingesting':
+            raise UploadStateError("This file is already being inserted.")
+        open(_path(upload_id, '.part'), 'wb').close()
+        state = {'table': table, 'filename': filename, 'size': size, 'received': 0,
+                 'status': 'receiving', 'ingested': 0, 'message': '', 'problems': 0, 'attempt': attempt}
+        _write_state(upload_id, state)
+        return state
+
+#Append one piece of the file, read from stream, at offset. The offset has to be the number of bytes already received, otherwise
+#nothing is written and the state is returned so the browser can carry on from the right place.
+def append_chunk(upload_id, offset, stream):
+    state = read_state(upload_id)
+    if state is None or state['status'] != 'receiving':
+        raise UploadStateError("There is no upload in progress with this id.")
+    part = _path(upload_id, '.part')
+    received = os.path.getsize(part)
+    if offset != received:
+        state['received'] = received
+        return state
+
+    # The piece goes to a file of its own first, the upload is only locked to check the offset again and append it
+    with tempfile.TemporaryFile(dir=upload_dir) as piece:
+        expected = state['size'] - offset
+        read = 0
+        while read < expected:
+            block = stream.read(min(write_block_size, expected - read))
+            if not block:
+                break
+            piece.write(block)
+            read += len(block)
+
+        with _locked(upload_id):
+            state = read_state(upload_id)
+            if state is None or state['status'] != 'receiving':
+                raise UploadStateError("There is no upload in progress with this id.")
+            received = os.path.getsize(part)
+            if offset == received:
+                piece.seek(0)
+                with open(part, 'ab') as file:
+                    shutil.copyfileobj(piece, file, write_block_size)
+                received += read
+            state['received'] = received
+            _write_state(upload_id, state)
+            return state
+
+#Record that the browser gave up on an upload
+def fail_upload(upload_id, message):
+    with _locked(upload_id):
+        state = read_state(upload_id)
+        if state is None or state['status'] in ('ingesting', 'done'):
+            return state
+        state['status'] = 'failed'
+        state['message'] = message
+        _write_state(upload_id, state)
+        return state
+
+#Raw file object that records how far into the file the ingest has read
+class _ProgressReader(io.RawIOBase):
+    def __init__(self, file, upload_id, state):
+        self.file = file
+        self.upload_id = upload_id
+        self.state = state
+        self.reported = time.monotonic()
+
+    def readinto(self, buffer):
+        read = self.file.readinto(buffer)
+        if time.monotonic() - self.reported >= progress_interval:
+            self.reported = time.monotonic()
+            self.state['ingested'] = self.file.tell()
+            _write_state(self.upload_id, self.state)
+        return read
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+#CSV report of the rows rejected and the problems found while inserting an upload, see validation.RejectsReport
+def rejects_path(upload_id):
+    return _path(upload_id, '.rejects.csv')
+
+def _ingest(upload_id, state, connect, on_done):
+    part = _path(upload_id, '.part')
+    rejects = rejects_path(upload_id)
+    try:
+        with connect() as conn, open(part, 'rb') as file, open(rejects, 'w', newline='', encoding='utf-8') as rejects_file:
+            result = upload.copy_upload(conn, state['table'], io.BufferedReader(_ProgressReader(file, upload_id, state)),
+                                        create_missing=state['table'] == 'homicide_complete', rejects_file=rejects_file)
+        state['status'] = 'done'
+        state['message'] = str(result)
+        state['problems'] = result.problems
+    except upload.UploadError as error:
+        state['status'] = 'failed'
+        state['message'] = f"Upload error: {error}"
+    except Exception as error:
+        state['status'] = 'failed'
+        state['message'] = f"An error occurred: {error}"
+    finally:
+        state['ingested'] = state['size']
+        _write_state(upload_id, state)
+        if os.path.exists(part):
+            os.remove(part)
+        if not state.get('problems') and os.path.exists(rejects):
+            os.remove(rejects)
+        if on_done is not None:
+            on_done()
+
+#Copy a fully received upload into its table on a background thread.
+#connect is a context manager giving a psycopg2 connection (db.get_connection), on_done is called when the ingest has finished.
+def start_ingest(upload_id, connect, on_done=None):
+    with _locked(upload_id):
+        state = read_state(upload_id)
+        if state is None or state['status'] != 'receiving':
+            raise UploadStateError("There is no upload waiting to be inserted with this id.")
+        if os.path.getsize(_path(upload_id, '.part')) != state['size']:
+            raise UploadStateError("The file has not been received completely.")
+        state['status'] = 'ingesting'
+        _write_state(upload_id, state)
+    threading.Thread(target=_ingest, args=(upload_id, state, connect, on_done), name=f"upload-{upload_id}", daemon=True).start()
+    return state
+
+#Remove the files of uploads that have not been touched for stale_after seconds
+def remove_stale_uploads():
+    if not os.path.isdir(upload_dir):
+        return
+    cutoff = time.time() - stale_after
+    for name in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+#One line describing the state of an upload for the dashboard
+def progress_message(state):
+    if state is None:
+        return "Starting upload..."
+    size_mb = state['size'] / 1e6
+    if state['status'] == 'receiving':
+        return f"Uploading {state['filename']}: {state['received'] / 1e6:.1f} of {size_mb:.1f} MB received."
+    if state['status'] == 'ingesting':
+        return f"Inserting {state['filename']} into {state['table']}: {100 * state['ingested'] / state['size']:.0f}% read."
+    return state['message']
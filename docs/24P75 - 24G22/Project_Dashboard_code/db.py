@@ -0,0 +1,107 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+from sqlalchemy.pool import QueuePool
+
+from config import config
+import metrics
+
+#database.ini lives next to this file, so the pool can be created no matter which directory the dashboard is started from
+database_ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.ini")
+
+#Defaults for the connection pool, these can be overridden in the [pool] section of database.ini
+#minconn is the number of connections kept open between requests, maxconn is the hard limit on connections to Postgres,
+#checkout_timeout is how many seconds a callback waits for a free connection and recycle is how many seconds a connection lives before it is replaced
+pool_defaults = {
+    'minconn': 2,
+    'maxconn': 10,
+    'checkout_timeout': 30,
+    'recycle': 1800
+}
+
+_engine = None
+_engine_lock = threading.Lock()
+
+#Read the pool settings from database.ini, falling back to the defaults for anything that is not set
+def pool_settings(filename=database_ini):
+    settings = dict(pool_defaults)
+    try:
+        overrides = config(filename, section="pool")
+    except Exception:
+        overrides = {}
+    for key, value in overrides.items():
+        if key in settings:
+            settings[key] = int(value)
+    return settings
+
+#Build the SQLAlchemy URL from the [postgresql] section of database.ini
+def database_url(filename=database_ini):
+    params = config(filename)
+    return URL.create(
+        "postgresql+psycopg2",
+        username=params.get('user'),
+        password=params.get('password'),
+        host=params.get('host'),
+        port=int(params['port']) if params.get('port') else None,
+        database=params.get('database')
+    )
+
+#The one pool shared by the whole process. It is only created the first time a connection is needed.
+#Every checkout hands a connection to a single thread, so connections are never shared between Flask worker threads,
+#and pool_pre_ping replaces connections that the server has dropped before they are handed out.
+#While metrics or the slow query log are on every connection hands out cursors that time their statements (see metrics.py).
+#They are only looked at here, so metrics.configure and slow_queries.configure have to run before the first connection.
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                settings = pool_settings()
+                _engine = create_engine(
+                    database_url(),
+                    poolclass=QueuePool,
+                    pool_size=settings['minconn'],
+                    max_overflow=max(settings['maxconn'] - settings['minconn'], 0),
+                    pool_timeout=settings['checkout_timeout'],
+                    pool_recycle=settings['recycle'],
+                    pool_pre_ping=True,
+                    connect_args={'cursor_factory': metrics.TimedCursor} if metrics.enabled or metrics.statement_listeners else {}
+                )
+                print(f"Connection pool created (min={settings['minconn']}, max={settings['maxconn']}).")
+    return _engine
+
+#Check a psycopg2 connection out of the pool for the duration of a with block.
+#The transaction is committed when the block finishes and rolled back if it raises. The connection goes back to the pool, unless
+#the block was left by something other than an Exception, such as the GeneratorExit of a streamed response whose client went
+#away: the connection may then be in the middle of a statement (a COPY), so it is invalidated and closed instead.
+@contextmanager
+def get_connection():
+    conn = get_engine().raw_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    except BaseException:
+        conn.invalidate()
+        raise
+    finally:
+        conn.close()
+
+#Run a SELECT through the pool and return the result as a DataFrame
+def read_sql(query, params=None):
+    with get_engine().connect() as connection:
+        return pd.read_sql_query(query, connection, params=params)
+
+#Close every pooled connection, used on shutdown and after a worker process forks
+def dispose():
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
@@ -0,0 +1,314 @@
+import argparse
+import csv
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from config import config
+
+#Throughput benchmark for the ways data gets into the database:
+#   copy                  copy_from_csv / copy_from_open_day_csv from main.py (one COPY over one connection)
+#   parallel_copy         parallel_load.parallel_copy (chunks over several connections, staging table swap)
+#   incremental_insert    incremental_load.incremental_load into an empty table (every row is new)
+#   incremental_unchanged incremental_load of the same file again (every row is skipped)
+#   to_sql                pandas read_csv + DataFrame.to_sql, the dashboards' CSV upload path (homicide_news only)
+#The input files are synthetic rows shaped like the real CSV files: ISO-8859-1 text, ';' delimiters, DD/MM/YYYY dates and
+#quoted notes containing delimiters and newlines. Every strategy runs in a fresh process so its peak RSS can be measured.
+#
+#The tables are dropped and created again for every run, so point it at a database used only for benchmarks:
+#   python load_benchmark.py --database homicide_benchmark --rows 10000 100000 --output results.json
+#   python load_benchmark.py --database homicide_benchmark --rows 10000 100000 --baseline results.json
+
+strategies = ['copy', 'parallel_copy', 'incremental_insert', 'incremental_unchanged', 'to_sql']
+tables = ['homicide_news', 'open_day_homicide_data']
+
+#---------------------------------------------------------------------------------------------------------------------------
+#Synthetic data
+
+first_names = ['Angela', 'Thandiwe', 'Nomvula', 'Zoë', 'Anél', 'Chloé', 'Lindiwe', 'Renée', 'Sipho', 'Thabo', 'André',
+               'Mpho', 'Bongani', 'Liné', 'Naledi', 'Jacó', 'Ayanda', 'Michélle', 'Kagiso', 'Lerato']
+last_names = ['Machinga', 'Dlamini', 'Nkosi', 'van der Merwe', 'Botha', 'Naidoo', 'Mokoena', 'Pillay', 'Müller',
+              'Khumalo', 'le Roux', 'Ndlovu', 'Steenkamp', 'Mthembu', 'Février', 'Zulu', 'Coetzée', 'Sithole']
+outlets = ['TIMES', 'SOWETAN', 'IOL', 'NEWS24', 'MAIL & GUARDIAN', 'THE STAR', 'CAPE ARGUS', 'DAILY DISPATCH', 'BEELD']
+province_codes = {'WC': 'Western Cape', 'GP': 'Gauteng', 'KZN': 'KwaZulu-Natal', 'EC': 'Eastern Cape', 'FS': 'Free State',
+                  'LP': 'Limpopo', 'MP': 'Mpumalanga', 'NW': 'North West', 'NC': 'Northern Cape'}
+towns = ['CAPE TOWN', 'JOHANNESBURG', 'DURBAN', 'PORT ELIZABETH', 'BLOEMFONTEIN', 'POLOKWANE', 'MBOMBELA', 'SOWETO',
+         'KHAYELITSHA', 'PIETERMARITZBURG', 'KIMBERLEY', 'RUSTENBURG']
+races = ['Black', 'White', 'Coloured', 'Indian', 'Asian', 'Unknown']
+locations = ['Home', 'Public', 'Work', 'Unknown']
+modes = ['Stabbed', 'Shot', 'Strangled', 'Blunt force', 'Burnt', 'Unknown']
+relationships = ['Intimate partner', 'Family member', 'Acquaintance', 'Stranger', 'Employer', 'Unknown']
+occupations = ['Domestic worker', 'Student', 'Teacher', 'Nurse', 'Unemployed', 'Vendor', 'Police officer', 'Unknown']
+ynu = ['Y', 'N', 'U']
+notes = ['TUTU FAMILY DOMESTIC WORKER', 'Body found in the veld; suspect fled', 'Victim was "well known" in the area',
+         'Two suspects, one arrested\nsecond still at large', 'Court case postponed; café owner testified', '']
+
+def _dmy(date):
+    return date.strftime('%d/%m/%Y')
+
+#One victim with the details every article about them shares
+def _victim(rnd):
+    death = datetime.date(2012, 1, 1) + datetime.timedelta(days=rnd.randrange(730))
+    province = rnd.choice(list(province_codes))
+    return {
+        'name': f"{rnd.choice(first_names)} {rnd.choice(last_names)}",
+        'death': death,
+        'age': rnd.choice([''] + [str(age) for age in range(1, 90)]),
+        'race': rnd.choice(races),
+        'province': province,
+        'town': rnd.choice(towns),
+        'location': rnd.choice(locations),
+        'mode': rnd.choice(modes),
+        'suspect': f"{rnd.choice(first_names)} {rnd.choice(last_names)}",
+        'relationship': rnd.choice(relationships),
+        'occupation': rnd.choice(occupations),
+        'flags': [rnd.choice(ynu) for _ in range(8)]
+    }
+
+#Rows of the homicide_news CSV file, several articles per victim
+def homicide_news_rows(count, seed):
+    rnd = random.Random(seed)
+    victim = None
+    for i in range(count):
+        if victim is None or rnd.random() < 0.2:
+            victim = _victim(rnd)
+        published = victim['death'] + datetime.timedelta(days=rnd.randrange(120))
+        outlet = rnd.choice(outlets)
+        flags = victim['flags']
+        yield [
+            f"http://www.{outlet.lower().replace(' ', '')}.co.za/news/{published:%Y/%m/%d}/article-{i}",
+            f"{victim['name']} killed in {victim['town'].title()}", outlet, _dmy(published),
+            f"{rnd.choice(first_names)} {rnd.choice(last_names)}", rnd.choice('YN'), str(rnd.randint(1, 5)),
+            victim['name'], _dmy(victim['death']), victim['race'], victim['age'], victim['province'], victim['town'],
+            victim['location'].upper(), flags[0], victim['mode'].upper(), flags[1], victim['suspect'], victim['relationship'],
+            flags[2], flags[3], flags[4], flags[5], flags[6], rnd.choice(notes)
+        ]
+
+#Rows of the Open Day CSV file, several articles per victim
+def open_day_rows(count, seed):
+    rnd = random.Random(seed)
+    victim = None
+    for i in range(count):
+        if victim is None or rnd.random() < 0.2:
+            victim = _victim(rnd)
+        published = victim['death'] + datetime.timedelta(days=rnd.randrange(120))
+        outlet = rnd.choice(outlets)
+        flags = victim['flags']
+        yield [
+            victim['name'], victim['death'].strftime('%B'), str(victim['death'].day), str(victim['death'].year), victim['age'],
+            victim['occupation'], victim['race'], victim['town'], victim['location'], victim['town'].title(),
+            province_codes[victim['province']], flags[0], victim['mode'], flags[1], flags[2], flags[3], victim['suspect'],
+            rnd.choice(['Male', 'Female', 'Unknown']), victim['relationship'], str(rnd.randint(1, 3)), flags[4], flags[5],
+            flags[6], rnd.choice(notes), outlet, f"{outlet[:3]}{i}", _dmy(published),
+            f"{rnd.choice(first_names)} {rnd.choice(last_names)}", f"article-{i}.pdf", f"clipping-{i}.pdf",
+            str(rnd.randint(1, 9)), rnd.choice('YN')
+        ]
+
+#Write a synthetic CSV file for table with count rows, reusing it if it was already generated
+def generate_csv(table, count, directory, seed=1):
+    from main import homicide_news_csv_columns, open_day_csv_columns
+
+    path = os.path.join(directory, f"synthetic_{table}_{count}_{seed}.csv")
+    if os.path.exists(path):
+        return path
+    if table == 'homicide_news':
+        header, rows = homicide_news_csv_columns, homicide_news_rows(count, seed)
+    else:
+        header, rows = [col.strip('"') for col in open_day_csv_columns], open_day_rows(count, seed)
+    partial = path + '.partial'
+    with open(partial, 'w', encoding='ISO-8859-1', newline='') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(partial, path)
+    print(f"Generated {path} ({os.path.getsize(path) / 1e6:.1f} MB).")
+    return path
+
+#---------------------------------------------------------------------------------------------------------------------------
+#Measurements
+
+#Highest resident set size of this process so far in MB, None where the resource module is not available (Windows)
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _recreate_table(cursor, table):
+    from main import create_homicide_news_table, create_open_day_homicide_table
+
+    if table == 'homicide_news':
+        create_homicide_news_table(cursor)
+    else:
+        create_open_day_homicide_table(cursor)
+
+#Run one strategy in this process and return its measurements. Creating the table is not part of the timed section.
+def run_strategy(strategy, table, csv_path, params, workers, chunk_mb):
+    import psycopg2
+    from main import homicide_news_csv_columns, open_day_csv_columns, copy_from_csv, copy_from_open_day_csv
+
+    columns = homicide_news_csv_columns if table == 'homicide_news' else open_day_csv_columns
+    connection = psycopg2.connect(**params)
+    try:
+        with connection.cursor() as cursor:
+            _recreate_table(cursor, table)
+            if strategy == 'incremental_unchanged':
+                from incremental_load import incremental_load
+                incremental_load(cursor, table, columns, csv_path)
+        connection.commit()
+
+        started = time.perf_counter()
+        if strategy == 'copy':
+            with connection.cursor() as cursor:
+                if table == 'homicide_news':
+                    copy_from_csv(cursor, csv_path)
+                else:
+                    copy_from_open_day_csv(cursor, csv_path)
+            connection.commit()
+        elif strategy == 'parallel_copy':
+            from parallel_load import parallel_copy
+            parallel_copy(table, columns, csv_path, workers, chunk_mb * 1024 * 1024, params)
+        elif strategy in ('incremental_insert', 'incremental_unchanged'):
+            from incremental_load import incremental_load
+            with connection.cursor() as cursor:
+                incremental_load(cursor, table, columns, csv_path)
+            connection.commit()
+        elif strategy == 'to_sql':
+            import pandas as pd
+            from sqlalchemy import create_engine
+            from sqlalchemy.engine import URL
+
+            engine = create_engine(URL.create("postgresql+psycopg2", username=params.get('user'), password=params.get('password'),
+                                              host=params.get('host'), port=int(params['port']) if params.get('port') else None,
+                                              database=params.get('database')))
+            # The same calls as the upload callbacks. The file is read as Latin-1, which is how it is encoded, and the DD/MM/YYYY
+            # dates are parsed here because the server would read them as MM/DD/YYYY
+            df = pd.read_csv(csv_path, sep=';', on_bad_lines='skip', encoding='ISO-8859-1',
+                             parse_dates=['date_of_publication', 'date_of_death'], dayfirst=True)
+            df.to_sql(table, engine, if_exists='append', index=False)
+            engine.dispose()
+        else:
+            raise ValueError(f"Unknown strategy: {strategy}")
+        seconds = time.perf_counter() - started
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            rows = cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+    size = os.path.getsize(csv_path)
+    return {
+        'strategy': strategy,
+        'table': table,
+        'rows': rows,
+        'bytes': size,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+        'mb_per_sec': round(size / 1e6 / seconds, 3) if seconds else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def _run_in_child(arguments):
+    return run_strategy(*arguments)
+
+#Run a strategy in a fresh process so that peak_rss_mb only covers that strategy
+def measure(strategy, table, csv_path, params, workers, chunk_mb):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(_run_in_child, ((strategy, table, csv_path, params, workers, chunk_mb),))
+
+#Compare results with an earlier results file, returning the measurements whose rows/sec dropped by more than tolerance
+def find_regressions(results, baseline_path, tolerance):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    previous = {(r['strategy'], r['table'], r['rows']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['strategy'], result['table'], result['rows']))
+        if not before or not before.get('rows_per_sec') or not result.get('rows_per_sec'):
+            continue
+        change = result['rows_per_sec'] / before['rows_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append({**result, 'baseline_rows_per_sec': before['rows_per_sec'], 'change': round(change, 3)})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the CSV loaders against a local Postgres.")
+    parser.add_argument('--database', default='homicide_benchmark',
+                        help="database to load into, its homicide tables are dropped (default homicide_benchmark)")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help="row counts to generate and load, 10000 to 10000000")
+    parser.add_argument('--strategies', nargs='+', choices=strategies, default=strategies)
+    parser.add_argument('--tables', nargs='+', choices=tables, default=tables)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'homicide_benchmark'),
+                        help="where the synthetic CSV files are written and reused from")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=4, help="connections used by parallel_copy")
+    parser.add_argument('--chunk-mb', type=int, default=16, help="chunk size used by parallel_copy")
+    parser.add_argument('--output', default='load_benchmark_results.json', help="JSON file the results are written to")
+    parser.add_argument('--baseline', help="earlier results file to compare with, exits with 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed drop in rows/sec before a result counts as a regression")
+    parser.add_argument('--generate-only', action='store_true', help="only write the synthetic CSV files")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    files = {(table, count): generate_csv(table, count, args.data_dir, args.seed) for count in args.rows for table in args.tables}
+    if args.generate_only:
+        return 0
+
+    params = config()
+    if args.database == params.get('database'):
+        parser.error("--database is the dashboard's database, the benchmark would drop its tables. Create a separate database for it.")
+    params['database'] = args.database
+
+    results = []
+    for (table, count), path in files.items():
+        for strategy in args.strategies:
+            if strategy == 'to_sql' and table != 'homicide_news':
+                continue
+            result = measure(strategy, table, path, params, args.workers, args.chunk_mb)
+            result['generated_rows'] = count
+            results.append(result)
+            print(f"{strategy:22} {table:24} {result['rows']:>10} rows {result['seconds']:>9.2f}s "
+                  f"{result['rows_per_sec']:>12,.0f} rows/s {result['mb_per_sec']:>8.2f} MB/s peak RSS {result['peak_rss_mb']} MB")
+
+    import psycopg2
+    with psycopg2.connect(**params) as connection, connection.cursor() as cursor:
+        cursor.execute("SHOW server_version")
+        server_version = cursor.fetchone()[0]
+    connection.close()
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'postgres': server_version,
+        'workers': args.workers,
+        'chunk_mb': args.chunk_mb,
+        'seed': args.seed,
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}.")
+
+    if args.baseline:
+        regressions = find_regressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['strategy']} {regression['table']} {regression['rows']} rows: "
+                  f"{regression['rows_per_sec']:,.0f} rows/s against {regression['baseline_rows_per_sec']:,.0f} ({regression['change']:+.0%})")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,85 +1,132 @@
+import argparse
 import psycopg2
 import psycopg2.extras
 from config import config
+from aggregates import create_aggregate_tables
+from cross_filter import create_filter_indexes
+from incremental_load import add_source_columns, incremental_load
+from xlsx_load import copy_from_xlsx, is_workbook
 
-def copy_from_csv(cursor, csv_file_path):
+# Change these to the directory where you have stored the CSV files, or pass --news-csv and --open-day-csv
+# (an .xlsx workbook from Project_Data can be given instead of a CSV file, see xlsx_load.py)
+csv_file_path = 'C:/Users/syedk/Documents/updated_investigation_project/investigation_new_2/investigation_project_v2-master/homicide_news_data.csv'
+open_day_csv_file_path = 'C:/Users/syedk/Documents/updated_investigation_project/investigation_new_2/investigation_project_v2-master/Open_day_data.csv'
+
+# Columns of the homicide_news CSV file in the order they appear in the file
+homicide_news_csv_columns = [
+    'news_report_url', 'news_report_headline', 'news_report_platform', 'date_of_publication', 'author',
+    'wire_service', 'no_of_subs', 'victim_name', 'date_of_death', 'race_of_victim', 'age_of_victim',
+    'place_of_death_province', 'place_of_death_town', 'type_of_location', 'sexual_assault',
+    'mode_of_death_specific', 'robbery_y_n_u', 'perpetrator_name', 'perpetrator_relationship_to_victim',
+    'suspect_arrested', 'suspect_convicted', 'multiple_murder', 'intimate_femicide_y_n_u',
+    'extreme_violence_y_n_m_u', 'notes'
+]
+
+# Columns of the Open Day CSV file in the order they appear in the file
+open_day_csv_columns = [
+    '"VICTIM NAME"', 'MONTH', 'DAY', 'YEAR', 'AGE', 'OCCUPATION', 'RACE', '"PLACE OF DEATH"',
+    '"LOCATION (HOME/PUBLIC/WORK/UNKNOWN)"', '"CITY/AREA"', 'PROVINCE', '"SEXUAL ASSAULT"', '"MODE OF DEATH"',
+    'ROBBERY', '"SUSPECT ARRESTED"', '"SUSPECT CONVICTED"', '"SUSPECT NAME"', '"SUSPECT GENDER"',
+    '"VIC SUSP RELATIONSHIP"', '"NO OF SUSPECTS"', '"INTIMATE FEMICIDE"', '"MULTIPLE MURDER"',
+    '"EXTREME VIOLENCE"', '"NOTES"', '"MEDIA COVERAGE URL OR NAME"', '"MEDIA CODE"', '"DATE OF ARTICLE"',
+    '"AUTHOR"', '"PDF NAME"', '"CLIPPING PDF NAME"', '"ARTICLE COUNT"', '"SAPA/WIRE"'
+]
+
+def copy_from_csv(cursor, csv_file_path, sheet=None):
+     if is_workbook(csv_file_path):
+        copy_from_xlsx(cursor, 'homicide_news', homicide_news_csv_columns, csv_file_path, sheet)
+        return
      with open(csv_file_path, 'r', encoding='ISO-8859-1') as file:
         # Copy data from the CSV file to the table
         cursor.execute('SET datestyle = "ISO, DMY";')
-        cursor.copy_expert("""COPY homicide_news(
-                            news_report_url,
-                            news_report_headline,
-                            news_report_platform,
-                            date_of_publication,
-                            author,
-                            wire_service,
-                            no_of_subs,
-                            victim_name,
-                            date_of_death,
-                            race_of_victim,
-                            age_of_victim,
-                            place_of_death_province,
-                            place_of_death_town,
-                            type_of_location,
-                            sexual_assault,
-                            mode_of_death_specific,
-                            robbery_y_n_u,
-                            perpetrator_name,
-                            perpetrator_relationship_to_victim,
-                            suspect_arrested,
-                            suspect_convicted,
-                            multiple_murder,
-                            intimate_femicide_y_n_u,
-                            extreme_violence_y_n_m_u,
-                            notes
-                            )
+        cursor.copy_expert(f"""COPY homicide_news({', '.join(homicide_news_csv_columns)})
         FROM STDIN WITH CSV HEADER DELIMITER ';'""", file)
         print("Data copied successfully to homicide_news.")
 
     
 
-def copy_from_open_day_csv(cursor, csv_file_path):
+def copy_from_open_day_csv(cursor, csv_file_path, sheet=None):
+    if is_workbook(csv_file_path):
+        copy_from_xlsx(cursor, 'open_day_homicide_data', open_day_csv_columns, csv_file_path, sheet)
+        return
     # Open the CSV file
     with open(csv_file_path, 'r', encoding='ISO-8859-1') as file:
         # Copy data from the CSV file to the table
         cursor.execute('SET datestyle = "ISO, DMY";')
-        cursor.copy_expert("""COPY open_day_homicide_data (
-                            "VICTIM NAME",
-                            MONTH,
-                            DAY,
-                            YEAR,
-                            AGE,
-                            OCCUPATION,
-                            RACE,
-                            "PLACE OF DEATH",
-                            "LOCATION (HOME/PUBLIC/WORK/UNKNOWN)",
-                            "CITY/AREA",
-                            PROVINCE, 
-                            "SEXUAL ASSAULT",
-                            "MODE OF DEATH",
-                            ROBBERY, 
-                            "SUSPECT ARRESTED",
-                            "SUSPECT CONVICTED",
-                            "SUSPECT NAME",
-                            "SUSPECT GENDER",
-                            "VIC SUSP RELATIONSHIP",
-                            "NO OF SUSPECTS",
-                            "INTIMATE FEMICIDE",
-                            "MULTIPLE MURDER",
-                            "EXTREME VIOLENCE",
-                            "NOTES",
-                            "MEDIA COVERAGE URL OR NAME",
-                            "MEDIA CODE",
-                            "DATE OF ARTICLE",
-                            "AUTHOR",
-                            "PDF NAME",
-                            "CLIPPING PDF NAME",
-                            "ARTICLE COUNT",
-                            "SAPA/WIRE"
-                            )
+        cursor.copy_expert(f"""COPY open_day_homicide_data ({', '.join(open_day_csv_columns)})
         FROM STDIN WITH CSV HEADER DELIMITER ';'""", file)
         print("Data copied successfully to Open_day_homicide_data.")
 
+# victim_key identifies one victim (normalised name plus date of death) as a hashed bigint. It is a stored generated column,
+# so every COPY, INSERT and upload fills it in, and distinct victim counts use COUNT(DISTINCT victim_key) on an index
+# instead of building a text key for every row. hashtextextended and the date difference are immutable, which generated columns require.
+homicide_news_victim_key = """hashtextextended(
+                                regexp_replace(lower(btrim(victim_name)), '\\s+', ' ', 'g'),
+                                date_of_death - DATE '1970-01-01')"""
+
+open_day_victim_key = """hashtextextended(
+                                regexp_replace(lower(btrim("VICTIM NAME")), '\\s+', ' ', 'g') || '|' || lower(btrim(MONTH)),
+                                0)"""
+
+# The Open Day file spreads the date of death over MONTH (a month name), DAY (text) and YEAR. These immutable functions turn them
+# into numbers and a DATE once, when a row is written, through the stored generated columns death_month and death_date, so the
+# charts can group and filter on indexed columns instead of parsing month names in pandas on every render.
+# Anything that is not a valid date (unknown day, 31 June, a misspelt month) gives NULL instead of failing the load.
+open_day_date_functions = [
+    """CREATE OR REPLACE FUNCTION open_day_month(month TEXT) RETURNS INT
+       LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+       SELECT CASE
+           WHEN btrim(month) ~ '^[0-9]{1,2}$' THEN CASE WHEN btrim(month)::int BETWEEN 1 AND 12 THEN btrim(month)::int END
+           ELSE (array_position(ARRAY['jan','feb','mar','apr','may','jun','jul','aug','sep','oct','nov','dec'],
+                                lower(left(btrim(month), 3))))
+       END $$""",
+    """CREATE OR REPLACE FUNCTION open_day_date(year INT, month TEXT, day TEXT) RETURNS DATE
+       LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+       SELECT CASE
+           WHEN year IS NULL OR year NOT BETWEEN 1 AND 9999 OR open_day_month(month) IS NULL OR btrim(day) !~ '^[0-9]{1,2}$' THEN NULL
+           WHEN btrim(day)::int BETWEEN 1 AND
+                date_part('day', make_date(year, open_day_month(month), 1) + interval '1 month - 1 day')::int
+               THEN make_date(year, open_day_month(month), btrim(day)::int)
+       END $$"""
+]
+
+open_day_date_columns = """death_date DATE GENERATED ALWAYS AS (open_day_date(YEAR, MONTH, DAY)) STORED,
+                            death_month INT GENERATED ALWAYS AS (open_day_month(MONTH)) STORED"""
+
+def create_open_day_date_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS open_day_death_date_idx ON open_day_homicide_data (death_date)")
+    # Covers the homicides over time chart: GROUP BY year, month with COUNT(DISTINCT victim_key)
+    cursor.execute("CREATE INDEX IF NOT EXISTS open_day_year_month_idx ON open_day_homicide_data (YEAR, death_month, victim_key)")
+    # Province, race and Y/N/U filters of the filter bar on the visualisation pages (see cross_filter.py)
+    create_filter_indexes(cursor, 'open_day_homicide_data')
+
+# Add the typed date columns to an open_day_homicide_data table created before they existed
+def add_open_day_date_columns(cursor):
+    for function in open_day_date_functions:
+        cursor.execute(function)
+    cursor.execute("""ALTER TABLE open_day_homicide_data
+                        ADD COLUMN IF NOT EXISTS death_date DATE GENERATED ALWAYS AS (open_day_date(YEAR, MONTH, DAY)) STORED,
+                        ADD COLUMN IF NOT EXISTS death_month INT GENERATED ALWAYS AS (open_day_month(MONTH)) STORED""")
+    create_open_day_date_indexes(cursor)
+
+# Where each row came from in its CSV file, filled in by incremental loads (see incremental_load.py)
+source_columns = """source_key VARCHAR(32),
+                            source_occurrence INT,
+                            row_hash VARCHAR(32)"""
+
+# Rows deleted in the dashboards stay in homicide_news with deleted_at set until they are purged (see bulk_delete.py).
+# The indexes the dashboards read through only cover the live rows, and the deleted rows have a small index of their own
+# for the Delete page and the purge.
+def add_soft_delete_column(cursor):
+    cursor.execute("ALTER TABLE homicide_news ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+    # Rows are archived into these tables with SELECT *, so they need the same trailing column
+    cursor.execute("ALTER TABLE IF EXISTS duplicates ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+    cursor.execute("ALTER TABLE IF EXISTS delete_dash ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+    cursor.execute("CREATE INDEX IF NOT EXISTS homicide_news_live_idx ON homicide_news (article_id) WHERE deleted_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS homicide_news_live_victim_key_idx ON homicide_news (victim_key) WHERE deleted_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS homicide_news_deleted_idx ON homicide_news (deleted_at) WHERE deleted_at IS NOT NULL")
+    create_filter_indexes(cursor, 'homicide_news')
+
 def create_homicide_news_table(cursor):
     # Drop the table if it already exists and create a new one
     cursor.execute("DROP TABLE IF EXISTS homicide_news CASCADE")
@@ -109,14 +156,25 @@ def create_homicide_news_table(cursor):
                             multiple_murder VARCHAR(10),
                             intimate_femicide_y_n_u VARCHAR(10),
                             extreme_violence_y_n_m_u VARCHAR(10),
-                            notes VARCHAR(1000)
-                            )'''
+                            notes VARCHAR(1000),
+                            victim_key BIGINT GENERATED ALWAYS AS ({victim_key}) STORED,
+                            {source_columns},
+                            deleted_at TIMESTAMP
+                            )'''.format(victim_key=homicide_news_victim_key, source_columns=source_columns)
     cursor.execute(create_script_homicide)
+    cursor.execute("CREATE UNIQUE INDEX homicide_news_source_key_idx ON homicide_news (source_key, source_occurrence)")
+    # Rows are archived into these tables with SELECT *, so they need the same trailing victim_key and source columns
+    cursor.execute("ALTER TABLE IF EXISTS duplicates ADD COLUMN IF NOT EXISTS victim_key BIGINT")
+    cursor.execute("ALTER TABLE IF EXISTS delete_dash ADD COLUMN IF NOT EXISTS victim_key BIGINT")
+    add_source_columns(cursor, 'homicide_news')
+    add_soft_delete_column(cursor)
     print("homicide_news Table created successfully.")
 
 def create_open_day_homicide_table(cursor):
     # Drop the table if it already exists and create a new one
     cursor.execute("DROP TABLE IF EXISTS open_day_homicide_data CASCADE")
+    for function in open_day_date_functions:
+        cursor.execute(function)
     create_script_open_day = '''CREATE TABLE open_day_homicide_data (                               
                             article_id SERIAL PRIMARY KEY,
                             "VICTIM NAME" VARCHAR(255),
@@ -150,12 +208,18 @@ def create_open_day_homicide_table(cursor):
                             "PDF NAME"VARCHAR(255),
                             "CLIPPING PDF NAME" VARCHAR(255),
                             "ARTICLE COUNT" INT,
-                            "SAPA/WIRE" VARCHAR(50)
-                            )'''
+                            "SAPA/WIRE" VARCHAR(50),
+                            victim_key BIGINT GENERATED ALWAYS AS ({victim_key}) STORED,
+                            {source_columns},
+                            {date_columns}
+                            )'''.format(victim_key=open_day_victim_key, source_columns=source_columns, date_columns=open_day_date_columns)
     cursor.execute(create_script_open_day)
+    cursor.execute("CREATE INDEX open_day_victim_key_idx ON open_day_homicide_data (victim_key)")
+    cursor.execute("CREATE UNIQUE INDEX open_day_homicide_data_source_key_idx ON open_day_homicide_data (source_key, source_occurrence)")
+    create_open_day_date_indexes(cursor)
     print("open_day_homicide_data Table created successfully.")
 
-def connect_and_create_tables():
+def connect_and_create_tables(news_csv=csv_file_path, open_day_csv=open_day_csv_file_path, sheet=None):
     connection = None
     csr = None
     try:
@@ -170,11 +234,12 @@ def connect_and_create_tables():
         create_open_day_homicide_table(csr)
 
         # Load data from CSV for the first table (homicide_news)
-        csv_file_path = 'C:/Users/syedk/Documents/updated_investigation_project/investigation_new_2/investigation_project_v2-master/homicide_news_data.csv'
-        copy_from_csv(csr, csv_file_path)
+        copy_from_csv(csr, news_csv, sheet)
         
-        open_day_csv_file_path = 'C:/Users/syedk/Documents/updated_investigation_project/investigation_new_2/investigation_project_v2-master/Open_day_data.csv'
-        copy_from_open_day_csv(csr, open_day_csv_file_path)
+        copy_from_open_day_csv(csr, open_day_csv, sheet)
+
+        # Build the aggregate tables the visualisations read from, triggers keep them up to date after this
+        create_aggregate_tables(csr)
 
         # Commit the changes
         connection.commit()
@@ -188,5 +253,114 @@ def connect_and_create_tables():
             connection.close()
             print('Database connection terminated.')
 
+# Load both CSV files with several connections at once (see parallel_load.py).
+# The live tables are only replaced once a file is completely loaded, and running this again after a failure or an
+# interruption carries on from the last chunk that was committed.
+def parallel_load_tables(news_csv=csv_file_path, open_day_csv=open_day_csv_file_path, workers=4, chunk_mb=16):
+    from parallel_load import parallel_copy
+
+    connection = None
+    try:
+        if is_workbook(news_csv) or is_workbook(open_day_csv):
+            raise ValueError("--parallel only loads CSV files, load workbooks without --parallel.")
+        connection = psycopg2.connect(**config())
+        with connection.cursor() as csr:
+            # The staging tables are shaped like the live tables, so create them first if they do not exist yet
+            csr.execute("SELECT to_regclass('homicide_news'), to_regclass('open_day_homicide_data')")
+            news_exists, open_day_exists = csr.fetchone()
+            if news_exists is None:
+                create_homicide_news_table(csr)
+            else:
+                add_soft_delete_column(csr)
+            if open_day_exists is None:
+                create_open_day_homicide_table(csr)
+            else:
+                add_open_day_date_columns(csr)
+        connection.commit()
+
+        chunk_bytes = chunk_mb * 1024 * 1024
+        parallel_copy('homicide_news', homicide_news_csv_columns, news_csv, workers, chunk_bytes)
+        parallel_copy('open_day_homicide_data', open_day_csv_columns, open_day_csv, workers, chunk_bytes)
+
+        # The swap dropped the old table and its triggers, build the aggregate tables again
+        with connection.cursor() as csr:
+            create_aggregate_tables(csr)
+        connection.commit()
+
+    except(Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    finally:
+        if connection is not None:
+            connection.close()
+            print('Database connection terminated.')
+
+# Move the rows deleted in the dashboards more than purge_after_days ago into delete_dash and vacuum homicide_news.
+# The Dash dashboard does this on its own every few hours, run it from a scheduled task when only the Streamlit app is used.
+def purge_deleted_rows(purge_after_days=None):
+    from bulk_delete import purge_deleted, purge_after_days as default_days
+
+    connection = None
+    try:
+        connection = psycopg2.connect(**config())
+        purged = purge_deleted(connection, default_days if purge_after_days is None else purge_after_days)
+        print(f"{purged} deleted row(s) purged.")
+    except(Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    finally:
+        if connection is not None:
+            connection.close()
+            print('Database connection terminated.')
+
+# Bring existing tables up to date with the CSV files without dropping them: only new and changed rows are written,
+# so edits made in the dashboard, the duplicates and delete_dash tables and everything that depends on the tables are kept
+def incremental_load_tables(news_csv=csv_file_path, open_day_csv=open_day_csv_file_path, sheet=None):
+    connection = None
+    try:
+        connection = psycopg2.connect(**config())
+        with connection.cursor() as csr:
+            csr.execute("SELECT to_regclass('homicide_news'), to_regclass('open_day_homicide_data'), to_regclass('agg_province')")
+            news_exists, open_day_exists, aggregates_exist = csr.fetchone()
+            if news_exists is None:
+                create_homicide_news_table(csr)
+            else:
+                add_soft_delete_column(csr)
+            if open_day_exists is None:
+                create_open_day_homicide_table(csr)
+            else:
+                add_open_day_date_columns(csr)
+
+            incremental_load(csr, 'homicide_news', homicide_news_csv_columns, news_csv, sheet)
+            # The aggregate triggers apply the inserted and updated rows to the aggregate tables
+            incremental_load(csr, 'open_day_homicide_data', open_day_csv_columns, open_day_csv, sheet)
+
+            if open_day_exists is None or aggregates_exist is None:
+                create_aggregate_tables(csr)
+        connection.commit()
+
+    except(Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    finally:
+        if connection is not None:
+            connection.close()
+            print('Database connection terminated.')
+
 if __name__ == "__main__":
-    connect_and_create_tables()
+    parser = argparse.ArgumentParser(description="Create the homicide tables and load them from the CSV files.")
+    parser.add_argument('--news-csv', default=csv_file_path, help="CSV file or .xlsx workbook for the homicide_news table")
+    parser.add_argument('--open-day-csv', default=open_day_csv_file_path, help="CSV file or .xlsx workbook for the open_day_homicide_data table")
+    parser.add_argument('--sheet', help="sheet to read from the workbooks, the first sheet is used when it is not given")
+    parser.add_argument('--parallel', action='store_true', help="load the files in chunks over several connections, resuming an interrupted load")
+    parser.add_argument('--incremental', action='store_true', help="keep the existing tables and only insert or update the rows that changed in the files")
+    parser.add_argument('--purge-deleted', action='store_true', help="move the rows deleted in the dashboards a while ago into delete_dash, instead of loading")
+    parser.add_argument('--purge-after-days', type=int, help="days a deleted row is kept for --purge-deleted, 30 when it is not given")
+    parser.add_argument('--workers', type=int, default=4, help="number of connections used by --parallel")
+    parser.add_argument('--chunk-mb', type=int, default=16, help="size of each chunk in MB for --parallel")
+    args = parser.parse_args()
+    if args.purge_deleted:
+        purge_deleted_rows(args.purge_after_days)
+    elif args.incremental:
+        incremental_load_tables(args.news_csv, args.open_day_csv, args.sheet)
+    elif args.parallel:
+        parallel_load_tables(args.news_csv, args.open_day_csv, args.workers, args.chunk_mb)
+    else:
+        connect_and_create_tables(args.news_csv, args.open_day_csv, args.sheet)
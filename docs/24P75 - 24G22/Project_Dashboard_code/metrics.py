@@ -0,0 +1,324 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+from config import config
+
+#Latency and size metrics of the dashboard, served in the Prometheus text format at /metrics.
+#   dashboard_callback_seconds / _response_bytes   every Dash callback, by the name of its function, timed by the Flask server
+#                                                  from the request to the response so the JSON encoding of the outputs is in it
+#   dashboard_sql_seconds / _rows                  every statement run on a pooled connection, by its fingerprint (the text of
+#                                                  the statement with its literals and lists replaced by ?)
+#   dashboard_figure_seconds                       turning a figure into the dict sent to the browser, by plot type
+#Metrics are off unless the [metrics] section of database.ini has enabled = true. When they are off, instrument adds no hooks and
+#no route, the pool hands out plain cursors, and every observe and timer returns after checking one flag.
+#Under serve.py the dashboard runs in several worker processes and a scrape of /metrics lands on any one of them. serve.py then
+#gives the workers a shared directory (multiprocess_variable): every worker writes its metrics to <pid>.json in it every
+#flush_interval seconds, and /metrics adds up the files of all the workers, so every scrape returns the totals of the whole
+#server. The files of workers that have stopped are kept, like the counts they made, until serve.py starts again.
+
+#Defaults, these can be overridden in the [metrics] section of database.ini
+#max_series is the most label values kept for one metric, the others are counted under "other" so a stream of different
+#statements cannot grow the metrics without bound
+metrics_defaults = {
+    'enabled': False,
+    'max_series': 500
+}
+
+#database.ini lives next to this file, like the one db.py reads
+database_ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.ini")
+
+enabled = False
+max_series = metrics_defaults['max_series']
+
+#Environment variable holding the directory the workers of serve.py share their metrics through
+multiprocess_variable = 'DASHBOARD_METRICS_DIR'
+
+#Seconds between the writes of a worker's metrics to the shared directory
+flush_interval = 5
+
+_metrics_dir = None
+_flush_thread = None
+
+#Upper bounds of the histogram buckets
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+row_buckets = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+byte_buckets = (1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+_registry = []
+
+#Turn metrics on or off from the [metrics] section of database.ini, called once when the dashboard starts
+def configure(filename=database_ini):
+    global enabled, max_series, _metrics_dir, _flush_thread
+    try:
+        settings = config(filename, section="metrics")
+    except Exception:
+        settings = {}
+    enabled = settings.get('enabled', str(metrics_defaults['enabled'])).strip().lower() in ('1', 'true', 'yes', 'on')
+    max_series = int(settings.get('max_series', metrics_defaults['max_series']))
+    _metrics_dir = os.environ.get(multiprocess_variable) or None
+    if enabled and _metrics_dir and _flush_thread is None:
+        os.makedirs(_metrics_dir, exist_ok=True)
+        _flush_thread = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+        _flush_thread.start()
+        atexit.register(_write_snapshot)
+    return enabled
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(number):
+    return repr(float(number)) if isinstance(number, float) else str(number)
+
+class Histogram:
+    def __init__(self, name, documentation, label, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value: [count in each bucket and above the last one, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, label_value, value):
+        if not enabled:
+            return
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                if len(self._series) >= max_series:
+                    label_value = 'other'
+                    series = self._series.get(label_value)
+                if series is None:
+                    series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {label_value: [list(counts), total, count] for label_value, (counts, total, count) in self._series.items()}
+
+    #Add the snapshot other into the snapshot series
+    @staticmethod
+    def merge(series, other):
+        for label_value, (counts, total, count) in other.items():
+            if label_value not in series:
+                series[label_value] = [list(counts), total, count]
+                continue
+            merged = series[label_value]
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+        return series
+
+    def expose(self, series=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        series = sorted((self.snapshot() if series is None else series).items())
+        for label_value, (counts, total, count) in series:
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {_format(total)}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name, documentation, label):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, label_value, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            if label_value not in self._values and len(self._values) >= max_series:
+                label_value = 'other'
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(values, other):
+        for label_value, value in other.items():
+            values[label_value] = values.get(label_value, 0) + value
+        return values
+
+    def expose(self, values=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        values = sorted((self.snapshot() if values is None else values).items())
+        lines.extend(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {_format(value)}' for label_value, value in values)
+        return lines
+
+callback_seconds = Histogram('dashboard_callback_seconds', "Time taken by a Dash callback request.", 'callback', latency_buckets)
+callback_response_bytes = Histogram('dashboard_callback_response_bytes', "Size of the response of a Dash callback.", 'callback',
+                                    byte_buckets)
+callback_errors = Counter('dashboard_callback_errors_total', "Dash callback requests that failed.", 'callback')
+sql_seconds = Histogram('dashboard_sql_seconds', "Time taken to execute a SQL statement.", 'fingerprint', latency_buckets)
+sql_rows = Histogram('dashboard_sql_rows', "Rows returned or changed by a SQL statement.", 'fingerprint', row_buckets)
+sql_errors = Counter('dashboard_sql_errors_total', "SQL statements that raised an error.", 'fingerprint')
+figure_seconds = Histogram('dashboard_figure_seconds', "Time taken to serialise a figure for the browser.", 'figure', latency_buckets)
+
+#Write the metrics of this process to its file in the shared directory
+def _write_snapshot():
+    if not _metrics_dir:
+        return
+    path = os.path.join(_metrics_dir, f"{os.getpid()}.json")
+    with open(path + '.tmp', 'w') as file:
+        json.dump({metric.name: metric.snapshot() for metric in _registry}, file)
+    os.replace(path + '.tmp', path)
+
+def _flush_loop():
+    while True:
+        time.sleep(flush_interval)
+        try:
+            _write_snapshot()
+        except Exception as error:
+            print(f"Error writing the metrics of worker {os.getpid()}: {error}")
+
+#Snapshots of every metric added up over the files of all the workers
+def _merged_snapshots():
+    _write_snapshot()
+    merged = {metric.name: {} for metric in _registry}
+    for path in glob.glob(os.path.join(_metrics_dir, '*.json')):
+        try:
+            with open(path) as file:
+                snapshots = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for metric in _registry:
+            metric.merge(merged[metric.name], snapshots.get(metric.name, {}))
+    return merged
+
+#All the metrics in the Prometheus text format, those of every worker when they share a directory
+def expose():
+    merged = _merged_snapshots() if _metrics_dir else {}
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose(merged.get(metric.name)))
+    return '\n'.join(lines) + '\n'
+
+#Time a block into a histogram: with metrics.timer(metrics.figure_seconds, 'line_plot'): ...
+class timer:
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.started = time.perf_counter() if enabled else None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.started is not None:
+            self.histogram.observe(self.label_value, time.perf_counter() - self.started)
+        return False
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+_value_list = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_array = re.compile(r"ARRAY\[[^\]]*\]", re.IGNORECASE)
+_whitespace = re.compile(r"\s+")
+
+#The statement with its literals, lists of values and parameters replaced by ?, so the same statement run with different values
+#is counted as one
+def fingerprint(statement):
+    text = _string_literal.sub('?', statement)
+    text = text.replace('%s', '?')
+    text = re.sub(r"%\(\w+\)s", '?', text)
+    text = _number_literal.sub('?', text)
+    text = _value_list.sub('(?)', text)
+    text = _array.sub('ARRAY[?]', text)
+    return _whitespace.sub(' ', text).strip()[:300]
+
+#Text of a query given to execute as a str, bytes or psycopg2.sql object
+def statement_text(cursor, query):
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    if not isinstance(query, str):
+        return query.as_string(cursor)
+    return query
+
+#Functions called with (cursor, query, vars, seconds, many) after every statement a TimedCursor has run without an error, such
+#as the slow query log in slow_queries.py. many is True for executemany, vars is then the list of parameters of every run.
+statement_listeners = []
+
+#Cursor that times every statement it executes, handed out by the pool in db.py while metrics or a statement listener are on
+class TimedCursor(psycopg2.extensions.cursor):
+    def _timed(self, run, query, vars=None, many=False):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = run()
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - started
+            if enabled:
+                name = fingerprint(statement_text(self, query))
+                sql_seconds.observe(name, seconds)
+                if failed:
+                    sql_errors.inc(name)
+                elif self.rowcount >= 0:
+                    sql_rows.observe(name, self.rowcount)
+            if not failed:
+                for listener in statement_listeners:
+                    listener(self, query, vars, seconds, many)
+
+    def execute(self, query, vars=None):
+        return self._timed(lambda: super(TimedCursor, self).execute(query, vars), query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(lambda: super(TimedCursor, self).executemany(query, vars_list), query, vars_list, True)
+
+#Name of the Dash callback a request to /_dash-update-component is for
+def _callback_name(app, request):
+    body = request.get_json(silent=True) or {}
+    output = body.get('output', 'unknown')
+    callback = app.callback_map.get(output, {}).get('callback')
+    return getattr(callback, '__name__', output)
+
+#Time the Dash callbacks of app and serve the metrics at /metrics, only when metrics are on
+def instrument(app):
+    if not enabled:
+        return
+    from flask import Response, g, request
+
+    server = app.server
+
+    @server.before_request
+    def start_callback_timer():
+        if request.path.endswith('/_dash-update-component'):
+            g.metrics_started = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        name = _callback_name(app, request)
+        callback_seconds.observe(name, time.perf_counter() - started)
+        if response.content_length is not None:
+            callback_response_bytes.observe(name, response.content_length)
+        if response.status_code >= 500:
+            callback_errors.inc(name)
+        return response
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return Response(expose(), mimetype='text/plain; version=0.0.4; charset=utf-8')
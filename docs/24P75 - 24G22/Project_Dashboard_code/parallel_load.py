@@ -0,0 +1,238 @@
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+
+from config import config
+
+#Parallel loader for the semicolon separated CSV files.
+#The file is split into row aligned byte ranges and the ranges are copied at the same time over several connections into an
+#unlogged staging table. Every chunk is committed together with a row in load_checkpoints, so if the load is interrupted
+#(or a chunk has a bad row) running it again only loads the chunks that are missing. When every chunk is in, the indexes are
+#built, the staging table is made durable and it replaces the live table in one transaction.
+
+#Size of the blocks read while looking for chunk boundaries
+scan_block_size = 1 << 20
+
+#The files are ISO-8859-1, the bytes are sent to Postgres as they are and decoded on the server
+client_encoding = 'LATIN1'
+
+#params are the connection parameters, the [postgresql] section of database.ini when they are not given
+def _connect(params=None):
+    return psycopg2.connect(**(params or config()))
+
+#Split the rows of a CSV file into byte ranges of roughly chunk_bytes each.
+#A range always ends at a newline outside quotes (an even number of '"' since the start of the data), so quoted fields
+#containing newlines are never split. Returns the byte offset after the header and the list of (start, end) ranges.
+def find_chunks(csv_file_path, chunk_bytes):
+    size = os.path.getsize(csv_file_path)
+    with open(csv_file_path, 'rb') as file:
+        file.readline()
+        data_start = file.tell()
+        boundaries = [data_start]
+        target = data_start + chunk_bytes
+        quotes = 0
+        block_start = data_start
+        while True:
+            block = file.read(scan_block_size)
+            if not block:
+                break
+            pos = 0
+            while pos < len(block):
+                if block_start + pos < target:
+                    skip_to = min(target - block_start, len(block))
+                    quotes += block.count(b'"', pos, skip_to)
+                    pos = skip_to
+                    continue
+                newline = block.find(b'\n', pos)
+                if newline == -1:
+                    quotes += block.count(b'"', pos)
+                    break
+                quotes += block.count(b'"', pos, newline + 1)
+                pos = newline + 1
+                if quotes % 2 == 0:
+                    boundaries.append(block_start + pos)
+                    target = block_start + pos + chunk_bytes
+            block_start += len(block)
+    if boundaries[-1] != size:
+        boundaries.append(size)
+    chunks = [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+    return data_start, chunks
+
+#File object returning only the bytes between start and end of a file, handed to copy_expert
+class ByteRangeReader:
+    def __init__(self, file, start, end):
+        self.file = file
+        self.remaining = end - start
+        self.file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+#Identifies one load of one file, so a re-run resumes only when the file and chunk size are unchanged
+def load_id_for(table, csv_file_path, chunk_bytes):
+    stat = os.stat(csv_file_path)
+    source = f"{table}|{os.path.abspath(csv_file_path)}|{stat.st_size}|{int(stat.st_mtime)}|{chunk_bytes}"
+    return hashlib.md5(source.encode('utf-8')).hexdigest()
+
+def create_checkpoint_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS load_checkpoints (
+                        load_id VARCHAR(32),
+                        table_name VARCHAR(255),
+                        chunk_no INT,
+                        start_byte BIGINT,
+                        end_byte BIGINT,
+                        rows_loaded BIGINT,
+                        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (load_id, chunk_no)
+                        )""")
+
+#Create an empty unlogged staging table shaped like the live table, without indexes so the COPYs do not maintain them
+def create_staging_table(cursor, table, staging):
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+    cursor.execute(f"CREATE UNLOGGED TABLE {staging} (LIKE {table} INCLUDING ALL EXCLUDING INDEXES)")
+    # Article ids start from 1 again, as they did when the table was dropped and created. The staging table numbers its rows
+    # from a sequence of its own, the one of the live table is still used by the dashboards until the swap.
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'article_id')", (table,))
+    if cursor.fetchone()[0]:
+        cursor.execute(f"CREATE SEQUENCE {staging}_article_id_seq OWNED BY {staging}.article_id")
+        cursor.execute(f"ALTER TABLE {staging} ALTER COLUMN article_id SET DEFAULT nextval('{staging}_article_id_seq')")
+
+#Work out which chunks still have to be loaded. A staging table left over from an interrupted load is only trusted if it
+#still holds exactly the rows the checkpoints say were loaded (unlogged tables are emptied after a crash).
+def prepare_load(connection, table, staging, load_id):
+    with connection.cursor() as cursor:
+        create_checkpoint_table(cursor)
+        cursor.execute("SELECT chunk_no, rows_loaded FROM load_checkpoints WHERE load_id = %s", (load_id,))
+        done = dict(cursor.fetchall())
+        cursor.execute("SELECT to_regclass(%s)", (staging,))
+        staging_exists = cursor.fetchone()[0] is not None
+        if done and staging_exists:
+            cursor.execute(f"SELECT COUNT(*) FROM {staging}")
+            if cursor.fetchone()[0] == sum(done.values()):
+                print(f"Resuming load into {table}: {len(done)} chunk(s) already loaded.")
+                connection.commit()
+                return done
+            print(f"Staging table {staging} does not match its checkpoints, starting the load again.")
+        cursor.execute("DELETE FROM load_checkpoints WHERE table_name = %s", (table,))
+        create_staging_table(cursor, table, staging)
+    connection.commit()
+    return {}
+
+#COPY one byte range of the file into the staging table on its own connection and record the checkpoint in the same transaction
+def load_chunk(table, staging, columns, csv_file_path, load_id, chunk_no, start, end, params=None):
+    connection = _connect(params)
+    try:
+        with connection.cursor() as cursor, open(csv_file_path, 'rb') as file:
+            cursor.execute(f"SET client_encoding = '{client_encoding}'")
+            cursor.execute('SET datestyle = "ISO, DMY";')
+            cursor.copy_expert(
+                f"COPY {staging} ({', '.join(columns)}) FROM STDIN WITH CSV DELIMITER ';'",
+                ByteRangeReader(file, start, end)
+            )
+            rows = cursor.rowcount
+            cursor.execute("""INSERT INTO load_checkpoints (load_id, table_name, chunk_no, start_byte, end_byte, rows_loaded)
+                              VALUES (%s, %s, %s, %s, %s, %s)""", (load_id, table, chunk_no, start, end, rows))
+        connection.commit()
+        return rows
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+#Recreate the indexes and index backed constraints of the live table on the staging table, with a _staging suffix
+def build_staging_indexes(cursor, table, staging):
+    cursor.execute("""SELECT i.relname, pg_get_indexdef(i.oid), c.conname, pg_get_constraintdef(c.oid)
+                      FROM pg_index x
+                      JOIN pg_class i ON i.oid = x.indexrelid
+                      LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+                      WHERE x.indrelid = %s::regclass""", (table,))
+    renames = []
+    for index_name, index_definition, constraint_name, constraint_definition in cursor.fetchall():
+        if constraint_name:
+            cursor.execute(f"ALTER TABLE {staging} ADD CONSTRAINT {constraint_name}_staging {constraint_definition}")
+            renames.append(('constraint', f"{constraint_name}_staging", constraint_name))
+        else:
+            definition = re.sub(r'^(CREATE (?:UNIQUE )?INDEX )(\S+)( ON (?:ONLY )?)(\S+)',
+                                lambda m: f"{m.group(1)}{index_name}_staging{m.group(3)}{staging}",
+                                index_definition)
+            cursor.execute(definition)
+            renames.append(('index', f"{index_name}_staging", index_name))
+    return renames
+
+#Make the staging table durable and swap it in for the live table in one transaction
+def swap_in_staging(connection, table, staging, load_id):
+    with connection.cursor() as cursor:
+        renames = build_staging_indexes(cursor, table, staging)
+        cursor.execute(f"ALTER TABLE {staging} SET LOGGED")
+        cursor.execute(f"ANALYZE {staging}")
+    connection.commit()
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'article_id'), pg_get_serial_sequence(%s, 'article_id')", (table, staging))
+        sequence, staging_sequence = cursor.fetchone()
+        # The sequence of the live table is dropped with it, the one of the staging table takes its name and carries on after
+        # the last article_id loaded
+        cursor.execute(f"DROP TABLE {table} CASCADE")
+        cursor.execute(f"ALTER TABLE {staging} RENAME TO {table}")
+        if staging_sequence:
+            cursor.execute(f"SELECT setval(%s, COALESCE(MAX(article_id), 0) + 1, false) FROM {table}", (staging_sequence,))
+            if sequence:
+                cursor.execute(f"ALTER SEQUENCE {staging_sequence} RENAME TO {sequence.split('.')[-1]}")
+        for kind, staging_name, name in renames:
+            if kind == 'constraint':
+                cursor.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {staging_name} TO {name}")
+            else:
+                cursor.execute(f"ALTER INDEX {staging_name} RENAME TO {name}")
+        cursor.execute("DELETE FROM load_checkpoints WHERE load_id = %s", (load_id,))
+    connection.commit()
+
+#Load a CSV file into table with several connections at once, resuming an interrupted load of the same file
+def parallel_copy(table, columns, csv_file_path, workers=4, chunk_bytes=16 * 1024 * 1024, params=None):
+    staging = f"{table}_staging"
+    load_id = load_id_for(table, csv_file_path, chunk_bytes)
+    started = time.perf_counter()
+    connection = _connect(params)
+    try:
+        done = prepare_load(connection, table, staging, load_id)
+        _, chunks = find_chunks(csv_file_path, chunk_bytes)
+        pending = [(chunk_no, start, end) for chunk_no, (start, end) in enumerate(chunks) if chunk_no not in done]
+        print(f"Loading {csv_file_path} into {table}: {len(chunks)} chunk(s), {len(pending)} to load with {workers} worker(s).")
+
+        failed = []
+        rows = sum(done.values())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(load_chunk, table, staging, columns, csv_file_path, load_id, chunk_no, start, end, params): chunk_no
+                for chunk_no, start, end in pending
+            }
+            for future in as_completed(futures):
+                chunk_no = futures[future]
+                try:
+                    rows += future.result()
+                except Exception as error:
+                    failed.append(chunk_no)
+                    print(f"Chunk {chunk_no} of {csv_file_path} failed: {error}")
+        if failed:
+            raise RuntimeError(f"{len(failed)} chunk(s) of {csv_file_path} failed to load, fix them and run the load again to resume.")
+
+        swap_in_staging(connection, table, staging, load_id)
+        elapsed = time.perf_counter() - started
+        print(f"Data copied successfully to {table}: {rows} rows in {elapsed:.1f}s.")
+        return rows
+    finally:
+        connection.close()
@@ -0,0 +1,116 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import cache
+import metrics
+from config import config
+
+#Production entry point of the Dash dashboard: python serve.py
+#On Linux and macOS the dashboard is served by gunicorn with workers processes of threads threads each, so callbacks run on
+#every core. Windows has no fork, so there it is served by waitress in one process with workers * threads threads.
+#All the workers share one results cache in a SQLite file (see cache.DiskCache), so an aggregate or figure is computed by one
+#worker and served by all of them, and a write through any worker invalidates it for all. Every worker has its own connection
+#pool from db.py, so workers * maxconn of the [pool] section has to stay below max_connections of Postgres.
+#Metrics are added up over the workers through files in metrics_dir (see metrics.py), so /metrics gives the totals of the whole
+#server whichever worker answers it. The slow query log is one file all the workers append to under a file lock (see
+#slow_queries.py), each entry with the pid of its worker.
+#Needs gunicorn (pip install gunicorn) or, on Windows, waitress (pip install waitress).
+
+#Defaults, these can be overridden in the [server] section of database.ini or on the command line
+server_defaults = {
+    'host': '127.0.0.1',
+    'port': 8050,
+    'workers': os.cpu_count() or 1,
+    'threads': 4,
+    # seconds a callback may take before gunicorn restarts its worker
+    'timeout': 120,
+    'cache_path': os.path.join(tempfile.gettempdir(), 'homicide_dashboard_cache.sqlite3'),
+    'metrics_dir': os.path.join(tempfile.gettempdir(), 'homicide_dashboard_metrics')
+}
+
+#Postgres allows 100 connections unless max_connections is changed, some are kept for loads and pgAdmin
+postgres_connections = 90
+
+#database.ini lives next to this file, like the one db.py reads
+database_ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.ini")
+
+#Read the server settings from database.ini, falling back to the defaults for anything that is not set
+def server_settings(filename=database_ini):
+    settings = dict(server_defaults)
+    try:
+        overrides = config(filename, section="server")
+    except Exception:
+        overrides = {}
+    for key, value in overrides.items():
+        if key in ('port', 'workers', 'threads', 'timeout'):
+            settings[key] = int(value)
+        elif key in settings:
+            settings[key] = value.strip()
+    return settings
+
+def _load_dashboard():
+    import dashboard
+    dashboard.start_background_jobs()
+    return dashboard.server
+
+def serve_gunicorn(settings):
+    from gunicorn.app.base import BaseApplication
+
+    class DashboardApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{settings['host']}:{settings['port']}")
+            self.cfg.set('workers', settings['workers'])
+            self.cfg.set('threads', settings['threads'])
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', settings['timeout'])
+            # Each worker imports the dashboard itself after it has forked, so no connection or thread is shared between them
+            self.cfg.set('preload_app', False)
+
+        def load(self):
+            return _load_dashboard()
+
+    DashboardApplication().run()
+
+def serve_waitress(settings):
+    from waitress import serve
+
+    serve(_load_dashboard(), host=settings['host'], port=settings['port'], threads=settings['workers'] * settings['threads'])
+
+if __name__ == "__main__":
+    settings = server_settings()
+    parser = argparse.ArgumentParser(description="Serve the dashboard with several worker processes and threads.")
+    parser.add_argument("--host", default=settings['host'], help="address to listen on")
+    parser.add_argument("--port", type=int, default=settings['port'], help="port to listen on")
+    parser.add_argument("--workers", type=int, default=settings['workers'], help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=settings['threads'], help="number of threads in each worker")
+    parser.add_argument("--cache-path", default=settings['cache_path'], help="SQLite file of the cache shared by the workers")
+    args = parser.parse_args()
+    settings.update(host=args.host, port=args.port, workers=max(args.workers, 1), threads=max(args.threads, 1),
+                    cache_path=args.cache_path)
+
+    # Read by cache.create_cache and metrics.configure in every worker. The metrics of an earlier run are cleared, the counts
+    # start from zero again like those of a single process.
+    os.environ[cache.shared_cache_variable] = settings['cache_path']
+    shutil.rmtree(settings['metrics_dir'], ignore_errors=True)
+    os.environ[metrics.multiprocess_variable] = settings['metrics_dir']
+
+    from db import pool_settings
+    connections = settings['workers'] * pool_settings()['maxconn']
+    if sys.platform != 'win32' and connections > postgres_connections:
+        print(f"Warning: {settings['workers']} workers may open up to {connections} connections to Postgres, "
+              f"lower --workers or maxconn in the [pool] section of database.ini.")
+
+    print(f"Serving the dashboard on http://{settings['host']}:{settings['port']}/ "
+          f"({settings['workers']} worker(s) x {settings['threads']} thread(s), cache in {settings['cache_path']}).")
+    server_package = 'waitress' if sys.platform == 'win32' else 'gunicorn'
+    try:
+        __import__(server_package)
+    except ImportError:
+        sys.exit(f"{server_package} is not installed, install it with pip install {server_package} to serve the dashboard.")
+    if sys.platform == 'win32':
+        serve_waitress(settings)
+    else:
+        serve_gunicorn(settings)
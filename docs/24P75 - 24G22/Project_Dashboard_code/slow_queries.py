@@ -0,0 +1,248 @@
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where serve.py runs a single process and the lock between threads is enough
+    fcntl = None
+
+import psycopg2.extensions
+
+from config import config
+import metrics
+
+#Log of the slow statements run by the dashboard, with their plans, to find what needs an index from the real workload.
+#Every statement run on a pooled connection is timed by the cursors of metrics.py. One that takes longer than threshold_ms is
+#written to a JSONL file together with its parameters, the function of the dashboard that ran it and its plan:
+#   SELECT statements (and WITH queries that do not change anything) are run again under EXPLAIN (ANALYZE, BUFFERS), so the
+#   plan has the real row counts, times and buffer reads
+#   statements that write only get EXPLAIN, running them again would change the data twice
+#The plan is read inside a savepoint, so a failing EXPLAIN does not abort the transaction of the caller, and only for
+#explain_sample_rate of the slow statements and at most once every explain_interval seconds for the same statement, so a slow
+#page that is opened over and over does not double its own cost.
+#The worker processes of serve.py all write to the same log. Rotating and appending is done under a lock on <log>.lock as well
+#as the lock between threads, so no worker rotates the file while another is writing to it, and every entry records the pid of
+#the worker that ran the statement.
+#python slow_queries.py prints the slowest statements of the log and the tables they read without an index.
+
+#Defaults, these can be overridden in the [slow_queries] section of database.ini
+slow_query_defaults = {
+    'enabled': False,
+    'threshold_ms': 500,
+    'explain_sample_rate': 1.0,
+    'explain_interval': 300,
+    'log': 'slow_queries.jsonl',
+    'max_log_mb': 50
+}
+
+#database.ini lives next to this file, like the one db.py reads, and so does the log unless a full path is given
+here = os.path.dirname(os.path.abspath(__file__))
+database_ini = os.path.join(here, "database.ini")
+
+settings = dict(slow_query_defaults)
+
+#Parameters are cut to this many characters in the log
+max_parameter_length = 200
+
+#Frames of the dashboard's own code kept as the caller of a statement
+caller_frames = 5
+
+_lock = threading.Lock()
+_last_explained = {}
+_recording = threading.local()
+
+#Statements whose plan can be read with ANALYZE without changing anything
+_read_only = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+_writes = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b|\bFOR\s+(UPDATE|SHARE)\b|\bnextval\s*\(|\bpg_\w*lock\w*\s*\(", re.IGNORECASE)
+_explainable = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+#Turn the log on or off from the [slow_queries] section of database.ini, called once when the dashboard starts and before the
+#first connection is made
+def configure(filename=database_ini):
+    try:
+        overrides = config(filename, section="slow_queries")
+    except Exception:
+        overrides = {}
+    settings.update(slow_query_defaults)
+    for key, value in overrides.items():
+        if key == 'enabled':
+            settings[key] = value.strip().lower() in ('1', 'true', 'yes', 'on')
+        elif key in ('threshold_ms', 'explain_sample_rate', 'explain_interval', 'max_log_mb'):
+            settings[key] = float(value)
+        elif key == 'log':
+            settings[key] = value.strip()
+    if settings['enabled'] and record not in metrics.statement_listeners:
+        metrics.statement_listeners.append(record)
+    elif not settings['enabled'] and record in metrics.statement_listeners:
+        metrics.statement_listeners.remove(record)
+    return settings['enabled']
+
+def log_path():
+    return os.path.join(here, settings['log'])
+
+#Frames of the dashboard's own code that led to the statement, outermost first, as file:line function
+def _caller():
+    skipped = {os.path.join(here, name) for name in ('metrics.py', 'slow_queries.py', 'db.py')}
+    frames = [f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}" for frame in traceback.extract_stack()
+              if os.path.abspath(frame.filename).startswith(here) and os.path.abspath(frame.filename) not in skipped]
+    return ' > '.join(frames[-caller_frames:]) or None
+
+def _parameter(value):
+    text = value if isinstance(value, str) else repr(value)
+    return text if len(text) <= max_parameter_length else text[:max_parameter_length] + '...'
+
+def _parameters(vars):
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {str(key): _parameter(value) for key, value in vars.items()}
+    return [_parameter(value) for value in vars]
+
+#Whether to read the plan of a slow statement now
+def _should_explain(name):
+    if random.random() >= settings['explain_sample_rate']:
+        return False
+    now = time.monotonic()
+    with _lock:
+        if now - _last_explained.get(name, -settings['explain_interval']) < settings['explain_interval']:
+            return False
+        _last_explained[name] = now
+    return True
+
+#The plan of statement run with vars on the connection of cursor, as (kind, plan, error)
+def _explain(cursor, statement, vars):
+    analyze = bool(_read_only.match(statement)) and not _writes.search(statement)
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    connection = cursor.connection
+    if connection.closed or connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        return None, None, "The transaction had already failed."
+    # A plain cursor, so the EXPLAIN is not timed and logged itself
+    explain_cursor = connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+    savepoint = not connection.autocommit
+    try:
+        if savepoint:
+            explain_cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            explain_cursor.execute(f"EXPLAIN ({options}) {statement}", vars)
+            plan = explain_cursor.fetchone()[0]
+        except Exception as error:
+            if savepoint:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return None, None, str(error).strip()
+        if savepoint:
+            explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return ('analyze' if analyze else 'estimate'), plan, None
+    finally:
+        explain_cursor.close()
+
+def _write(entry):
+    path = log_path()
+    line = json.dumps(entry, default=str) + '\n'
+    with _lock, open(path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(path) and os.path.getsize(path) > settings['max_log_mb'] * 1024 * 1024:
+                os.replace(path, path + '.1')
+            with open(path, 'a', encoding='utf-8') as file:
+                file.write(line)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+#Statement listener of metrics.TimedCursor: log the statement if it was slow
+def record(cursor, query, vars, seconds, many=False):
+    if seconds * 1000 < settings['threshold_ms'] or getattr(_recording, 'active', False):
+        return
+    _recording.active = True
+    try:
+        statement = metrics.statement_text(cursor, query)
+        name = metrics.fingerprint(statement)
+        entry = {
+            'logged_at': datetime.now().isoformat(timespec='seconds'),
+            'ms': round(seconds * 1000, 1),
+            'pid': os.getpid(),
+            'fingerprint': name,
+            'statement': statement,
+            'parameters': None if many else _parameters(vars),
+            'runs': len(vars) if many and isinstance(vars, (list, tuple)) else 1,
+            'rows': cursor.rowcount,
+            'caller': _caller(),
+            'plan_kind': None,
+            'plan': None,
+            'explain_error': None
+        }
+        if not many and _explainable.match(statement) and _should_explain(name):
+            entry['plan_kind'], entry['plan'], entry['explain_error'] = _explain(cursor, statement, vars)
+        _write(entry)
+    except Exception as error:
+        print(f"Error in the slow query log: {error}")
+    finally:
+        _recording.active = False
+
+#The plan nodes of a plan read by EXPLAIN (FORMAT JSON), depth first
+def plan_nodes(plan):
+    if isinstance(plan, list):
+        plan = plan[0] if plan else {}
+    stack = [plan.get('Plan', plan)]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.get('Plans', [])))
+
+#Slowest statements of a log, and the tables read by a sequential scan in their plans with the rows the scans removed
+def summarise(path=None):
+    statements = defaultdict(lambda: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'callers': set()})
+    scans = defaultdict(lambda: {'plans': 0, 'rows_removed': 0, 'filters': set()})
+    with open(path or log_path(), encoding='utf-8') as file:
+        for line in file:
+            entry = json.loads(line)
+            summary = statements[entry['fingerprint']]
+            summary['count'] += 1
+            summary['total_ms'] += entry['ms']
+            summary['max_ms'] = max(summary['max_ms'], entry['ms'])
+            if entry.get('caller'):
+                summary['callers'].add(entry['caller'])
+            for node in plan_nodes(entry.get('plan') or {}):
+                if node.get('Node Type') == 'Seq Scan':
+                    scan = scans[node.get('Relation Name')]
+                    scan['plans'] += 1
+                    scan['rows_removed'] += node.get('Rows Removed by Filter', 0)
+                    if node.get('Filter'):
+                        scan['filters'].add(node['Filter'])
+    ranked = sorted(statements.items(), key=lambda item: item[1]['total_ms'], reverse=True)
+    return ranked, sorted(scans.items(), key=lambda item: item[1]['rows_removed'], reverse=True)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarise the slow query log of the dashboard.")
+    parser.add_argument("log", nargs="?", help="the JSONL log, by default the one set in database.ini")
+    parser.add_argument("--top", type=int, default=20, help="number of statements to list")
+    args = parser.parse_args()
+
+    configure()
+    path = args.log or log_path()
+    if not os.path.exists(path):
+        sys.exit(f"No slow query log at {path}.")
+    ranked, scans = summarise(path)
+    print("Slowest statements (total ms, times logged, slowest ms):")
+    for name, summary in ranked[:args.top]:
+        print(f"{summary['total_ms']:>12.0f} {summary['count']:>6} {summary['max_ms']:>10.0f}  {name}")
+        for caller in sorted(summary['callers']):
+            print(f"{'':>31}from {caller}")
+    print()
+    print("Tables read by a sequential scan (plans, rows removed by the filter, filters):")
+    for table, scan in scans:
+        print(f"{table}: {scan['plans']} plan(s), {scan['rows_removed']} rows removed")
+        for condition in sorted(scan['filters']):
+            print(f"    {condition}")
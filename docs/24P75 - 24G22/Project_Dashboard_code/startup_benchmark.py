@@ -0,0 +1,136 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+#Startup benchmark for the Dash dashboard: how long a fresh Python process takes to import it, which is what every start and
+#every gunicorn worker started by serve.py pays before it serves its first request.
+#Every run imports the module in a new process under python -X importtime, so nothing is already loaded, and records:
+#   seconds             wall time of the import
+#   slowest_imports     the modules that took longest to import, by their own time
+#   side_effects        anything the import should have left for the first request: a connection pool (db.py), the GeoJSON
+#                       of the choropleth, plotly.express
+#No database is needed, an import that tries to connect fails the run.
+#   python startup_benchmark.py --repeat 10 --output startup.json
+#   python startup_benchmark.py --repeat 10 --baseline startup.json
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+#Run in the child process, prints the measurements of one import as JSON on the last line of its output
+child_code = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+side_effects = []
+db = sys.modules.get('db')
+if db is not None and db._engine is not None:
+    side_effects.append('connection pool created')
+load_geojson = getattr({module}, 'load_geojson', None)
+if load_geojson is not None and load_geojson.cache_info().currsize:
+    side_effects.append('GeoJSON loaded')
+if 'plotly.express' in sys.modules:
+    side_effects.append('plotly.express imported')
+print(json.dumps({{'seconds': seconds, 'side_effects': side_effects}}))
+"""
+
+#Own time of every module in the -X importtime output, in seconds
+def parse_importtime(output):
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(own) / 1e6
+    return times
+
+#Import module once in a fresh process and return its measurements
+def measure(module, slowest):
+    environment = dict(os.environ)
+    # The in-process cache, so a cache file left by serve.py is not opened
+    environment.pop('DASHBOARD_CACHE_PATH', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', child_code.format(module=module)], cwd=here,
+                            env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip()}")
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = parse_importtime(result.stderr)
+    measurement['slowest_imports'] = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:slowest]
+    return measurement
+
+def summarise(module, runs):
+    seconds = [run['seconds'] for run in runs]
+    return {
+        'module': module,
+        'runs': len(runs),
+        'median_seconds': round(statistics.median(seconds), 4),
+        'min_seconds': round(min(seconds), 4),
+        'max_seconds': round(max(seconds), 4),
+        'side_effects': sorted({effect for run in runs for effect in run['side_effects']}),
+        'slowest_imports': [[name, round(own, 4)] for name, own in runs[-1]['slowest_imports']]
+    }
+
+#Compare results with an earlier results file, returning the modules whose median import time grew by more than tolerance
+def find_regressions(results, baseline_path, tolerance):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    previous = {result['module']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['module'])
+        if not before or not before.get('median_seconds'):
+            continue
+        change = result['median_seconds'] / before['median_seconds'] - 1
+        if change > tolerance:
+            regressions.append({**result, 'baseline_median_seconds': before['median_seconds'], 'change': round(change, 3)})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long the dashboard takes to import in a fresh process.")
+    parser.add_argument('--modules', nargs='+', default=['dashboard'], help="modules to import (default dashboard)")
+    parser.add_argument('--repeat', type=int, default=5, help="fresh processes per module, the first one warms the disk cache")
+    parser.add_argument('--slowest', type=int, default=10, help="number of slowest imports to list")
+    parser.add_argument('--output', default='startup_benchmark_results.json', help="JSON file the results are written to")
+    parser.add_argument('--baseline', help="earlier results file to compare with, exits with 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed growth of the median before it counts as a regression")
+    args = parser.parse_args()
+
+    results = []
+    failed = False
+    for module in args.modules:
+        # The first import reads every file from disk, the runs measured are the ones after it
+        measure(module, args.slowest)
+        result = summarise(module, [measure(module, args.slowest) for _ in range(max(args.repeat, 1))])
+        results.append(result)
+        print(f"{module}: median {result['median_seconds']:.3f}s (min {result['min_seconds']:.3f}s, "
+              f"max {result['max_seconds']:.3f}s over {result['runs']} runs)")
+        for name, own in result['slowest_imports']:
+            print(f"    {own:>8.3f}s  {name}")
+        if result['side_effects']:
+            failed = True
+            print(f"    Done at import instead of on first use: {', '.join(result['side_effects'])}")
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}.")
+
+    if args.baseline:
+        regressions = find_regressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['module']}: {regression['median_seconds']:.3f}s against "
+                  f"{regression['baseline_median_seconds']:.3f}s ({regression['change']:+.0%})")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
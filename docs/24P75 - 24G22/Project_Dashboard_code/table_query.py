@@ -0,0 +1,216 @@
+import re
+
+from psycopg2 import sql
+
+import db
+
+#Turns the page, sort and filter state of a DataTable running with page_action, sort_action and filter_action set to 'custom'
+#into one parameterised query. Pages are read with keyset pagination: the sort key of the first and last row of the page on screen
+#is remembered, so the next or previous page is an index range scan instead of an OFFSET over every row before it.
+
+#Column that breaks ties in the sort order so that every row has a unique position, for tables that do not pass their own
+tiebreak_column = 'article_id'
+
+#Condition on the rows shown from tables whose deleted rows stay in the table (see bulk_delete.py)
+shown_rows = {'homicide_news': sql.SQL('deleted_at IS NULL')}
+
+#Operators produced by the DataTable filter row, longest first so that '>=' is matched before '>'
+filter_operators = [
+    ('is not blank', 'not_blank'), ('is not nil', 'not_nil'), ('is blank', 'blank'), ('is nil', 'nil'),
+    ('datestartswith', 'startswith'), ('contains', 'contains'),
+    ('>=', '>='), ('<=', '<='), ('!=', '!='), ('=', '='), ('>', '>'), ('<', '<'),
+    ('ge', '>='), ('le', '<='), ('ne', '!='), ('eq', '='), ('gt', '>'), ('lt', '<')
+]
+
+filter_part_pattern = re.compile(r'^\{(?P<column>[^}]+)\}\s*(?P<rest>.*)$')
+
+#Remove the quotes the DataTable puts around filter values
+def _unquote(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+        return value[1:-1].replace('\\' + value[0], value[0])
+    return value
+
+#Escape the LIKE wildcards in a user supplied value
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+#Split one '{column} operator value' part of a filter query into its column, operator, value and case sensitivity
+def split_filter_part(part):
+    match = filter_part_pattern.match(part.strip())
+    if not match:
+        raise ValueError(f"Unsupported filter: {part}")
+    column = match.group('column').strip()
+    rest = match.group('rest').strip()
+    #the DataTable filters are case sensitive unless the operator carries an 'i' prefix
+    case_sensitive = True
+    if rest[:1] in ('s', 'i') and not rest.startswith(('is ', 'is\t')):
+        for text, _ in filter_operators:
+            if rest[1:].startswith(text):
+                case_sensitive = rest[0] == 's'
+                rest = rest[1:]
+                break
+    for text, operator in filter_operators:
+        if rest.startswith(text):
+            value = rest[len(text):]
+            if text[0].isalpha() and value and not value[0].isspace():
+                continue
+            return column, operator, _unquote(value), case_sensitive
+    raise ValueError(f"Unsupported filter: {part}")
+
+#Build the WHERE clause for a DataTable filter_query. Columns are checked against allowed_columns and every value is passed as a parameter.
+def build_where(filter_query, allowed_columns):
+    conditions = []
+    params = []
+    if not filter_query:
+        return sql.SQL('TRUE'), params
+    if '||' in filter_query:
+        raise ValueError("Only filters joined with && are supported.")
+    for part in filter_query.split(' && '):
+        if not part.strip():
+            continue
+        column, operator, value, case_sensitive = split_filter_part(part)
+        if column not in allowed_columns:
+            raise ValueError(f"Unknown column: {column}")
+        identifier = sql.Identifier(column)
+        if operator == 'nil':
+            conditions.append(sql.SQL("{} IS NULL").format(identifier))
+        elif operator == 'not_nil':
+            conditions.append(sql.SQL("{} IS NOT NULL").format(identifier))
+        elif operator == 'blank':
+            conditions.append(sql.SQL("({0} IS NULL OR btrim({0}::text) = '')").format(identifier))
+        elif operator == 'not_blank':
+            conditions.append(sql.SQL("({0} IS NOT NULL AND btrim({0}::text) <> '')").format(identifier))
+        elif operator == 'contains':
+            like = sql.SQL('LIKE' if case_sensitive else 'ILIKE')
+            conditions.append(sql.SQL("{}::text {} %s").format(identifier, like))
+            params.append(f"%{_escape_like(value)}%")
+        elif operator == 'startswith':
+            conditions.append(sql.SQL("{}::text LIKE %s").format(identifier))
+            params.append(f"{_escape_like(value)}%")
+        elif operator == '=' and not case_sensitive:
+            conditions.append(sql.SQL("lower({}::text) = lower(%s)").format(identifier))
+            params.append(value)
+        else:
+            conditions.append(sql.SQL("{} " + operator + " %s").format(identifier))
+            params.append(value)
+    if not conditions:
+        return sql.SQL('TRUE'), params
+    return sql.SQL(' AND ').join(conditions), params
+
+#The sort keys for a DataTable sort_by, always ending with the tiebreak column so the order is total
+def sort_keys(sort_by, allowed_columns, tiebreak=tiebreak_column):
+    keys = []
+    for item in sort_by or []:
+        column = item.get('column_id')
+        if column not in allowed_columns:
+            raise ValueError(f"Unknown column: {column}")
+        if column == tiebreak:
+            continue
+        keys.append((column, 'desc' if item.get('direction') == 'desc' else 'asc'))
+    keys.append((tiebreak, 'asc'))
+    return keys
+
+#ORDER BY clause for the sort keys, nulls always sort last. reverse is used to read the page before the one on screen.
+def build_order_by(keys, reverse=False):
+    parts = []
+    for column, direction in keys:
+        descending = (direction == 'desc') != reverse
+        parts.append(sql.SQL("{} {} {}").format(
+            sql.Identifier(column),
+            sql.SQL('DESC' if descending else 'ASC'),
+            sql.SQL('NULLS FIRST' if reverse else 'NULLS LAST')
+        ))
+    return sql.SQL(', ').join(parts)
+
+#Predicate selecting the rows that come strictly after (or before) the row whose sort key values are given
+def build_keyset(keys, values, after=True):
+    (column, direction), value = keys[0], values[0]
+    identifier = sql.Identifier(column)
+    ascending = (direction == 'asc') == after
+    if len(keys) == 1:
+        return sql.SQL("{} {} %s").format(identifier, sql.SQL('>' if ascending else '<')), [value]
+    rest, rest_params = build_keyset(keys[1:], values[1:], after)
+    if value is None:
+        if after:
+            #nulls sort last, so after a null only the rows with a null in this column and a later key remain
+            return sql.SQL("({} IS NULL AND {})").format(identifier, rest), rest_params
+        return sql.SQL("({0} IS NOT NULL OR ({0} IS NULL AND {1}))").format(identifier, rest), rest_params
+    comparison = sql.SQL('>' if ascending else '<')
+    if after:
+        condition = sql.SQL("({0} {1} %s OR {0} IS NULL OR ({0} = %s AND {2}))").format(identifier, comparison, rest)
+    else:
+        condition = sql.SQL("({0} {1} %s OR ({0} = %s AND {2}))").format(identifier, comparison, rest)
+    return condition, [value, value] + rest_params
+
+#Make a value safe to send to the browser and to keep in a dcc.Store
+def _json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+#Fetch one page of rows for a DataTable.
+#state is what the previous call returned: when the request is for the page next to the one on screen and the sort and filter have not
+#changed, the page is read with a keyset predicate, otherwise the rows are found with OFFSET. The row count is only recomputed when the filter changes.
+#tiebreak is a unique column of table.
+def fetch_page(table, columns, allowed_columns, page_current, page_size, sort_by=None, filter_query=None, state=None,
+               tiebreak=tiebreak_column):
+    columns = [col for col in columns if col in allowed_columns]
+    if not columns:
+        raise ValueError("No columns selected.")
+    page_current = page_current or 0
+    keys = sort_keys(sort_by, allowed_columns, tiebreak)
+    key_columns = [column for column, _ in keys]
+    where, where_params = build_where(filter_query, allowed_columns)
+    if table in shown_rows:
+        where = sql.SQL("{} AND ({})").format(shown_rows[table], where)
+    signature = {'table': table, 'sort': [list(key) for key in keys], 'filter': filter_query or ''}
+    state = state or {}
+    same_query = state.get('signature') == signature
+
+    select_columns = columns + [col for col in key_columns if col not in columns]
+    select_list = sql.SQL(', ').join(sql.Identifier(col) for col in select_columns)
+    table_identifier = sql.Identifier(table)
+
+    reverse = False
+    offset = page_current * page_size
+    predicate, predicate_params = sql.SQL('TRUE'), []
+    if same_query and page_current == state.get('page', -1) + 1 and state.get('last') is not None:
+        predicate, predicate_params = build_keyset(keys, state['last'], after=True)
+        offset = 0
+    elif same_query and page_current == state.get('page', -1) - 1 and state.get('first') is not None:
+        predicate, predicate_params = build_keyset(keys, state['first'], after=False)
+        offset = 0
+        reverse = True
+
+    query = sql.SQL("SELECT {columns} FROM {table} WHERE ({where}) AND {predicate} ORDER BY {order} LIMIT %s OFFSET %s").format(
+        columns=select_list,
+        table=table_identifier,
+        where=where,
+        predicate=predicate,
+        order=build_order_by(keys, reverse)
+    )
+
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, where_params + predicate_params + [page_size, offset])
+            rows = cursor.fetchall()
+            if same_query and state.get('total') is not None:
+                total = state['total']
+            else:
+                cursor.execute(sql.SQL("SELECT COUNT(*) FROM {} WHERE {}").format(table_identifier, where), where_params)
+                total = cursor.fetchone()[0]
+
+    if reverse:
+        rows.reverse()
+    records = [{col: _json_value(value) for col, value in zip(select_columns, row)} for row in rows]
+    key_positions = [select_columns.index(col) for col in key_columns]
+    new_state = {
+        'signature': signature,
+        'page': page_current,
+        'total': total,
+        'first': [_json_value(rows[0][i]) for i in key_positions] if rows else None,
+        'last': [_json_value(rows[-1][i]) for i in key_positions] if rows else None
+    }
+    page_count = max((total + page_size - 1) // page_size, 1)
+    return records, page_count, new_state
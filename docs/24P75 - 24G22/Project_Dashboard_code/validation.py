@@ -0,0 +1,174 @@
+import csv
+from datetime import date
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+#Validation of rows before they are written to the homicide tables.
+#Rows are checked a batch at a time with whole column operations rather than row by row: every column is factorized into its
+#distinct values, the checks (pandas string methods, isin, to_datetime) run once on those values, and the result is mapped back
+#to the rows through the codes, so a column of 50000 rows with a few hundred distinct values costs a few hundred checks. The type checks come from the table itself: integer columns must hold whole numbers, date columns dates in one of
+#date_formats and VARCHAR columns no more than their length, so they follow the DDL in main.py. The categorical columns are
+#checked against the values the dashboards offer, plus the spellings found in the project's data (see domain_rules).
+#Every problem found is written to a rejects report with the line of the file, the column, the value and the reason.
+
+#Rows checked at a time
+batch_size = 50000
+
+#Problems kept in memory for the message shown in the dashboards, the report file gets all of them
+max_reported_problems = 100
+
+#Allowed values, compared ignoring case and surrounding spaces. Empty values are always allowed and stored as they are.
+yes_no_values = ['Y', 'N', 'U', 'Yes', 'No', 'Unknown']
+yes_no_maybe_values = yes_no_values + ['M', 'Maybe']
+#YN is used in the project's data for suspects convicted of some of the charges, or some of the suspects
+conviction_values = yes_no_values + ['YN']
+province_values = [
+    'Western Cape', 'Eastern Cape', 'Northern Cape', 'Gauteng', 'Free State', 'Mpumalanga', 'KwaZulu-Natal', 'Limpopo',
+    'North West', 'WC', 'EC', 'NC', 'GP', 'GT', 'FS', 'MP', 'KZN', 'LP', 'NW', 'Unknown'
+]
+race_values = ['African', 'Black', 'White', 'Coloured', 'Indian', 'Asian', 'Indian/Asian', 'Other', 'Unknown']
+relationship_values = [
+    'Family', 'Friend', 'Acquaintance', 'Stranger', 'Affair', 'Criminal', 'Ex-partner', 'Labourer', 'Neighbour', 'Police',
+    'Romantic partner', 'Spouse', 'Relative', 'Unknown', 'Other'
+]
+
+#Column: (allowed values, whether a value outside them rejects the row). The relationship is free text in much of the
+#existing data, so an unexpected relationship is only reported.
+domain_rules = {
+    'sexual_assault': (yes_no_values, True),
+    'robbery_y_n_u': (yes_no_values, True),
+    'suspect_arrested': (yes_no_values, True),
+    'suspect_convicted': (conviction_values, True),
+    'multiple_murder': (yes_no_values, True),
+    'intimate_femicide_y_n_u': (yes_no_values, True),
+    'extreme_violence_y_n_m_u': (yes_no_maybe_values, True),
+    'place_of_death_province': (province_values, True),
+    'race_of_victim': (race_values, True),
+    'perpetrator_relationship_to_victim': (relationship_values, False)
+}
+
+#Column: (smallest, largest) value allowed, None for no largest value
+range_rules = {
+    'age_of_victim': (0, 120),
+    'no_of_subs': (0, None)
+}
+
+#Date formats accepted, all of them are read the same way by Postgres with datestyle DMY
+date_formats = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d', '%d-%b-%y', '%d-%b-%Y', '%d %b %Y', '%d %B %Y']
+
+integer_limits = {'smallint': 2 ** 15 - 1, 'integer': 2 ** 31 - 1, 'bigint': 2 ** 63 - 1}
+
+#Rejected rows and the problems found in them, written as CSV to file (a text file object) when one is given
+class RejectsReport:
+    header = ['line', 'column', 'value', 'problem', 'action']
+
+    def __init__(self, file=None):
+        self.writer = csv.writer(file) if file is not None else None
+        if self.writer:
+            self.writer.writerow(self.header)
+        self.rows_rejected = 0
+        self.problems = 0
+        self.examples = []
+
+    def add(self, line, column, value, problem, rejected=True):
+        self.add_many([line], column, [value], problem, rejected)
+
+    #The same problem with one column on several lines
+    def add_many(self, lines, column, values, problem, rejected=True):
+        self.problems += len(lines)
+        text = f"{column}: {problem}" if column else problem
+        for line in lines[:max(max_reported_problems - len(self.examples), 0)]:
+            self.examples.append((int(line), text, rejected))
+        if self.writer:
+            self.writer.writerows(zip(lines, repeat(column), values, repeat(problem), repeat('rejected' if rejected else 'kept')))
+
+    #A row rejected before it could be checked column by column (wrong number of fields, broken quoting)
+    def reject_row(self, line, problem):
+        self.rows_rejected += 1
+        self.add(line, '', '', problem)
+
+class Validator:
+    #columns are (header name, table column, data_type, character_maximum_length) in the order of the fields of a row
+    def __init__(self, columns):
+        self.columns = columns
+
+    #Validator for rows of the given table columns, with the types read from information_schema.
+    #headers are the names of the columns in the file, used in the report, when they differ from the table's.
+    @classmethod
+    def for_table(cls, cursor, table, columns, headers=None):
+        cursor.execute("""SELECT column_name, data_type, character_maximum_length FROM information_schema.columns
+                          WHERE table_schema = current_schema() AND table_name = %s""", (table,))
+        types = {name: (data_type, max_length) for name, data_type, max_length in cursor.fetchall()}
+        return cls([(header, name) + types.get(name, ('text', None)) for header, name in zip(headers or columns, columns)])
+
+    #Check a batch of rows (lists of strings, all as long as columns) read from lines of the file.
+    #Problems go to report; returns a numpy array of booleans, True for the rows that can be written.
+    def check(self, rows, lines, report):
+        accepted = np.ones(len(rows), dtype=bool)
+        if not rows:
+            return accepted
+        lines = np.asarray(lines)
+        for (header, column, data_type, max_length), field in zip(self.columns, zip(*rows)):
+            codes, uniques = pd.factorize(np.array(field, dtype=object))
+            uniques = pd.Series(uniques, dtype=object)
+            for failed, problem, rejected in self._problems(column, uniques, data_type, max_length):
+                failed = np.flatnonzero(failed.to_numpy(dtype=bool))
+                if not len(failed):
+                    continue
+                failed_rows = np.isin(codes, failed)
+                indexes = np.flatnonzero(failed_rows)
+                report.add_many(lines[indexes].tolist(), header, uniques.to_numpy()[codes[indexes]].tolist(), problem, rejected)
+                if rejected:
+                    accepted &= ~failed_rows
+        report.rows_rejected += int((~accepted).sum())
+        return accepted
+
+    #(mask of the failing values, problem, whether the row is rejected) for every check of the distinct values of one column
+    def _problems(self, column, values, data_type, max_length):
+        stripped = values.str.strip()
+        present = stripped != ''
+        if max_length is not None:
+            yield values.str.len() > max_length, f"longer than {max_length} characters", True
+        if data_type in integer_limits:
+            whole = stripped.str.fullmatch(r'[+-]?\d+')
+            yield present & ~whole, "not a whole number", True
+            numbers = pd.to_numeric(stripped.where(present & whole), errors='coerce')
+            yield numbers.abs() > integer_limits[data_type], "too large", True
+            if column in range_rules:
+                low, high = range_rules[column]
+                if high is None:
+                    yield numbers < low, f"less than {low}", True
+                else:
+                    yield (numbers < low) | (numbers > high), f"not between {low} and {high}", True
+        elif data_type == 'date':
+            dates = parse_dates(stripped.where(present))
+            yield present & dates.isna(), "not a date (day/month/year)", True
+            yield dates > pd.Timestamp(date.today()), "in the future", True
+        if column in domain_rules:
+            allowed, rejected = domain_rules[column]
+            outside = present & ~stripped.str.upper().isin([value.upper() for value in allowed])
+            yield outside, "not an allowed value", rejected
+
+    #Problems with one record (a dict of column: value) about to be inserted, the rejecting ones only
+    def check_record(self, record):
+        report = RejectsReport()
+        row = []
+        for header, _, _, _ in self.columns:
+            value = record.get(header)
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            row.append('' if value is None else str(value))
+        self.check([row], [1], report)
+        return [problem for _, problem, rejected in report.examples if rejected]
+
+#Parse a Series of strings with the first of date_formats that fits each value, NaT where none does
+def parse_dates(values):
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in date_formats:
+        remaining = values.notna() & parsed.isna()
+        if not remaining.any():
+            break
+        parsed[remaining] = pd.to_datetime(values[remaining], format=fmt, errors='coerce')
+    return parsed
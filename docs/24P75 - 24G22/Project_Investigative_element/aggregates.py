@@ -0,0 +1,144 @@
+#Aggregate tables behind the charts on the Data Visualization page.
+#Each chart reads a small table holding the number of distinct victims for every combination of the columns it plots,
+#so the charts no longer scan open_day_homicide_data. The tables are kept up to date by statement level triggers on
+#open_day_homicide_data: every insert, COPY, update and delete only adds or removes the rows it touched.
+#
+#For every chart there are two tables:
+#   <name>_members  one row per (chart columns, victim) with the number of articles about that victim
+#   <name>          one row per combination of chart columns with the number of distinct victims
+#A victim is added to <name> when its first article arrives and removed when its last article is deleted.
+#NULL values are stored as '' so the chart columns can be part of the primary key; read them back with NULLIF(column, '').
+
+source_table = 'open_day_homicide_data'
+
+#Column identifying one victim, the stored hash created in main.py
+victim_key_expression = 'victim_key'
+victim_key_type = 'BIGINT'
+
+#Aggregate table name -> list of (column in the aggregate table, column in open_day_homicide_data)
+aggregate_tables = {
+    'agg_province': [('province', 'province')],
+    'agg_race': [('race', 'race')],
+    'agg_suspect_gender': [('suspect_gender', 'SUSPECT GENDER')],
+    'agg_relationship': [('relationship', 'VIC SUSP RELATIONSHIP')],
+    'agg_relationship_mode': [('relationship', 'VIC SUSP RELATIONSHIP'), ('mode_of_death', 'MODE OF DEATH')],
+    'agg_location': [('location', 'LOCATION (HOME/PUBLIC/WORK/UNKNOWN)')],
+    'agg_mode_conviction': [('mode_of_death', 'MODE OF DEATH'), ('suspect_convicted', 'SUSPECT CONVICTED')]
+}
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def _join_condition(columns, left, right):
+    return ' AND '.join(f"{left}.{col} = {right}.{col}" for col in columns)
+
+#Statement adding the rows of source (a table or a trigger transition table) to one aggregate
+def _add_statement(name, dimensions, source):
+    columns = [col for col, _ in dimensions]
+    column_list = ', '.join(columns)
+    select_dimensions = ', '.join(f"coalesce({_quote(src)}::text, '') AS {col}" for col, src in dimensions)
+    group_positions = ', '.join(str(i + 1) for i in range(len(columns) + 1))
+    return f"""
+        WITH delta AS (
+            SELECT {select_dimensions}, {victim_key_expression} AS victim_key, count(*) AS articles
+            FROM {source}
+            WHERE {victim_key_expression} IS NOT NULL
+            GROUP BY {group_positions}
+        ),
+        created AS (
+            SELECT {', '.join('d.' + col for col in columns)}, count(*) AS victims
+            FROM delta d
+            LEFT JOIN {name}_members m ON {_join_condition(columns, 'm', 'd')} AND m.victim_key = d.victim_key
+            WHERE m.victim_key IS NULL
+            GROUP BY {', '.join('d.' + col for col in columns)}
+        ),
+        upserted AS (
+            INSERT INTO {name}_members AS m ({column_list}, victim_key, articles)
+            SELECT {column_list}, victim_key, articles FROM delta
+            ON CONFLICT ({column_list}, victim_key) DO UPDATE SET articles = m.articles + EXCLUDED.articles
+        )
+        INSERT INTO {name} AS a ({column_list}, victims)
+        SELECT {column_list}, victims FROM created
+        ON CONFLICT ({column_list}) DO UPDATE SET victims = a.victims + EXCLUDED.victims;"""
+
+#Statements removing the rows of source from one aggregate
+def _remove_statements(name, dimensions, source):
+    columns = [col for col, _ in dimensions]
+    select_dimensions = ', '.join(f"coalesce({_quote(src)}::text, '') AS {col}" for col, src in dimensions)
+    group_positions = ', '.join(str(i + 1) for i in range(len(columns) + 1))
+    return f"""
+        WITH delta AS (
+            SELECT {select_dimensions}, {victim_key_expression} AS victim_key, count(*) AS articles
+            FROM {source}
+            WHERE {victim_key_expression} IS NOT NULL
+            GROUP BY {group_positions}
+        ),
+        updated AS (
+            UPDATE {name}_members m SET articles = m.articles - d.articles
+            FROM delta d
+            WHERE {_join_condition(columns, 'm', 'd')} AND m.victim_key = d.victim_key
+            RETURNING {', '.join('m.' + col for col in columns)}, m.articles
+        ),
+        emptied AS (
+            SELECT {', '.join(columns)}, count(*) AS victims FROM updated WHERE articles <= 0 GROUP BY {', '.join(columns)}
+        )
+        UPDATE {name} a SET victims = a.victims - e.victims
+        FROM emptied e
+        WHERE {_join_condition(columns, 'a', 'e')};
+        DELETE FROM {name}_members WHERE articles <= 0;
+        DELETE FROM {name} WHERE victims <= 0;"""
+
+def _function(function_name, body):
+    return f"""
+        CREATE OR REPLACE FUNCTION {function_name}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            -- one writer at a time, so two transactions adding the same new victim cannot both count it
+            PERFORM pg_advisory_xact_lock(hashtext('{source_table}_aggregates'));
+            {body}
+            RETURN NULL;
+        END
+        $$"""
+
+#(Re)create the aggregate tables and their triggers and fill them from the current contents of open_day_homicide_data.
+#The aggregate tables only hold derived data, so they are dropped and built again whenever the source table is (re)created.
+def create_aggregate_tables(cursor):
+    for name, dimensions in aggregate_tables.items():
+        columns = [col for col, _ in dimensions]
+        column_definitions = ', '.join(f"{col} TEXT NOT NULL" for col in columns)
+        cursor.execute(f"DROP TABLE IF EXISTS {name}_members, {name}")
+        cursor.execute(f"""CREATE TABLE {name}_members (
+                            {column_definitions},
+                            victim_key {victim_key_type} NOT NULL,
+                            articles INT NOT NULL,
+                            PRIMARY KEY ({', '.join(columns)}, victim_key)
+                            )""")
+        cursor.execute(f"CREATE INDEX {name}_members_empty ON {name}_members ({', '.join(columns)}) WHERE articles <= 0")
+        cursor.execute(f"""CREATE TABLE {name} (
+                            {column_definitions},
+                            victims INT NOT NULL,
+                            PRIMARY KEY ({', '.join(columns)})
+                            )""")
+        cursor.execute(_add_statement(name, dimensions, source_table))
+
+    add_new_rows = ''.join(_add_statement(name, dims, 'new_rows') for name, dims in aggregate_tables.items())
+    remove_old_rows = ''.join(_remove_statements(name, dims, 'old_rows') for name, dims in aggregate_tables.items())
+    truncate_all = ''.join(f"\n            TRUNCATE {name}_members, {name};" for name in aggregate_tables)
+
+    cursor.execute(_function(f"{source_table}_aggregates_insert", add_new_rows))
+    cursor.execute(_function(f"{source_table}_aggregates_delete", remove_old_rows))
+    cursor.execute(_function(f"{source_table}_aggregates_update", remove_old_rows + add_new_rows))
+    cursor.execute(_function(f"{source_table}_aggregates_truncate", truncate_all))
+
+    triggers = [
+        ('insert', 'AFTER INSERT', 'REFERENCING NEW TABLE AS new_rows'),
+        ('delete', 'AFTER DELETE', 'REFERENCING OLD TABLE AS old_rows'),
+        ('update', 'AFTER UPDATE', 'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+        ('truncate', 'AFTER TRUNCATE', '')
+    ]
+    for event, timing, referencing in triggers:
+        trigger_name = f"{source_table}_aggregates_{event}"
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger_name} ON {source_table}")
+        cursor.execute(f"""CREATE TRIGGER {trigger_name} {timing} ON {source_table}
+                            {referencing}
+                            FOR EACH STATEMENT EXECUTE FUNCTION {trigger_name}()""")
+    print("Aggregate tables for the visualisations created successfully.")
@@ -0,0 +1,235 @@
+import datetime
+import json
+
+import pandas as pd
+from psycopg2 import sql
+
+from duplicate_detection import province_codes
+
+#Global filter applied to every chart of the visualisation pages.
+#The filter bar keeps its state as a plain dict, in a dcc.Store or st.session_state:
+#   {'provinces': ['gauteng'],                       province names, matched whichever spelling or code the rows use
+#    'years': [2012, 2013],                          first and last year of death, either may be None
+#    'races': ['african'],
+#    'flags': {'intimate_femicide': ['Y']}}          Y/N/U columns and the answers wanted
+#condition turns the state into WHERE conditions with every value passed as a parameter, written with the same expressions as
+#the indexes made by create_filter_indexes so Postgres can answer them from an index. base_result reads the filtered rows once,
+#grouped by everything the charts of the visualisation page show, and each chart counts its victims from that DataFrame, so a
+#page of charts costs one query however many charts are drawn from it.
+
+#Columns of each table: the ones filtered on, the Y/N/U flags, and the ones the charts are drawn from. The year is a column
+#of open_day_homicide_data and is taken from the date of death in homicide_news.
+sources = {
+    'open_day_homicide_data': {
+        'province': 'province',
+        'race': 'race',
+        'year': 'year',
+        'month': 'death_month',
+        'date': None,
+        'flags': {
+            'intimate_femicide': 'INTIMATE FEMICIDE', 'sexual_assault': 'SEXUAL ASSAULT', 'robbery': 'robbery',
+            'multiple_murder': 'MULTIPLE MURDER', 'extreme_violence': 'EXTREME VIOLENCE',
+            'suspect_arrested': 'SUSPECT ARRESTED', 'suspect_convicted': 'SUSPECT CONVICTED'
+        },
+        'columns': {
+            'province': 'province', 'race': 'race', 'age': 'age', 'suspect_gender': 'SUSPECT GENDER',
+            'relationship': 'VIC SUSP RELATIONSHIP', 'mode_of_death': 'MODE OF DEATH',
+            'location': 'LOCATION (HOME/PUBLIC/WORK/UNKNOWN)', 'suspect_convicted': 'SUSPECT CONVICTED'
+        },
+        'rows': None
+    },
+    'homicide_news': {
+        'province': 'place_of_death_province',
+        'race': 'race_of_victim',
+        'year': None,
+        'month': None,
+        'date': 'date_of_death',
+        'flags': {
+            'intimate_femicide': 'intimate_femicide_y_n_u', 'sexual_assault': 'sexual_assault', 'robbery': 'robbery_y_n_u',
+            'multiple_murder': 'multiple_murder', 'extreme_violence': 'extreme_violence_y_n_m_u',
+            'suspect_arrested': 'suspect_arrested', 'suspect_convicted': 'suspect_convicted'
+        },
+        'columns': {
+            'province': 'place_of_death_province', 'race': 'race_of_victim', 'age': 'age_of_victim',
+            'relationship': 'perpetrator_relationship_to_victim', 'mode_of_death': 'mode_of_death_specific',
+            'location': 'type_of_location', 'suspect_convicted': 'suspect_convicted'
+        },
+        # deleted rows stay in homicide_news until they are purged (see bulk_delete.py)
+        'rows': 'deleted_at IS NULL'
+    }
+}
+
+#Province names offered by the filter bar, each also matches the codes used for it in the data
+province_names = sorted(set(province_codes.values()))
+
+#Y/N/U columns that can be filtered on, the same in both tables
+flag_names = list(sources['open_day_homicide_data']['flags'])
+
+#Answers of the Y/N/U columns, compared on their first letter so 'Yes' and 'Unknown' match as well
+flag_answers = {'Y': 'Yes', 'N': 'No', 'U': 'Unknown'}
+
+class FilterError(ValueError):
+    pass
+
+def flag_label(name):
+    return name.replace('_', ' ').capitalize()
+
+def _texts(values):
+    return sorted({str(value).strip().lower() for value in values or [] if value is not None and str(value).strip()})
+
+#Check a filter state and return it in its canonical form
+def normalise(state):
+    state = state or {}
+    provinces = _texts(state.get('provinces'))
+    for name in provinces:
+        if name not in province_names:
+            raise FilterError(f"Unknown province: {name}.")
+
+    years = list(state.get('years') or [None, None])
+    if len(years) != 2:
+        raise FilterError("Years are given as the first and the last year.")
+    try:
+        years = [None if year in (None, '') else int(year) for year in years]
+    except (TypeError, ValueError):
+        raise FilterError("Years have to be whole numbers.")
+    if any(year is not None and not 1 <= year < 9999 for year in years):
+        raise FilterError("Years have to be between 1 and 9998.")
+    if None not in years and years[0] > years[1]:
+        raise FilterError(f"The years {years[0]} to {years[1]} end before they start.")
+
+    flags = {}
+    for name, answers in sorted((state.get('flags') or {}).items()):
+        if name not in flag_names:
+            raise FilterError(f"Unknown flag: {name}.")
+        answers = sorted({str(answer).strip()[:1].upper() for answer in
+                          (answers if isinstance(answers, (list, tuple)) else [answers]) if answer})
+        for answer in answers:
+            if answer not in flag_answers:
+                raise FilterError(f"{flag_label(name)} is answered with Y, N or U.")
+        if answers:
+            flags[name] = answers
+
+    return {'provinces': provinces, 'years': years if years != [None, None] else None, 'races': _texts(state.get('races')),
+            'flags': flags}
+
+def is_active(state):
+    state = normalise(state)
+    return bool(state['provinces'] or state['years'] or state['races'] or state['flags'])
+
+#Key identifying a filter, the same for every state that normalises to the same thing
+def state_key(state):
+    return json.dumps(normalise(state), sort_keys=True, separators=(',', ':'))
+
+#One line describing a filter for the dashboards
+def describe(state):
+    state = normalise(state)
+    parts = [', '.join(name.title() for name in state['provinces'])] if state['provinces'] else []
+    if state['years']:
+        first, last = state['years']
+        parts.append(f"{first or '...'}-{last or '...'}" if first != last else str(first))
+    if state['races']:
+        parts.append(', '.join(name.title() for name in state['races']))
+    for name, answers in state['flags'].items():
+        parts.append(f"{flag_label(name).lower()}: {'/'.join(flag_answers[answer] for answer in answers)}")
+    return "All charts show: " + ('; '.join(parts) if parts else "all records") + "."
+
+#The expressions conditions and indexes are written with
+def _text_key(column):
+    return sql.SQL("lower(btrim({}))").format(sql.Identifier(column))
+
+def _flag_key(column):
+    return sql.SQL("upper(left(btrim({}), 1))").format(sql.Identifier(column))
+
+def _values_condition(key, values, params):
+    if len(values) == 1:
+        params.append(values[0])
+        return sql.SQL("{} = %s").format(key)
+    params.append(values)
+    return sql.SQL("{} = ANY(%s)").format(key)
+
+#WHERE conditions of a filter on the source table, and their parameters, without the conditions of the table itself
+def condition(source, state):
+    state = normalise(state)
+    columns = sources[source]
+    conditions = []
+    params = []
+    if state['provinces']:
+        spellings = sorted(set(state['provinces']) |
+                           {code.lower() for code, name in province_codes.items() if name in state['provinces']})
+        conditions.append(_values_condition(_text_key(columns['province']), spellings, params))
+    if state['years']:
+        first, last = state['years']
+        if columns['date']:
+            # A range on the date itself rather than on its year, so the index on the date can be used
+            if first is not None:
+                conditions.append(sql.SQL("{} >= %s").format(sql.Identifier(columns['date'])))
+                params.append(datetime.date(first, 1, 1))
+            if last is not None:
+                conditions.append(sql.SQL("{} < %s").format(sql.Identifier(columns['date'])))
+                params.append(datetime.date(last + 1, 1, 1))
+        else:
+            if first is not None:
+                conditions.append(sql.SQL("{} >= %s").format(sql.Identifier(columns['year'])))
+                params.append(first)
+            if last is not None:
+                conditions.append(sql.SQL("{} <= %s").format(sql.Identifier(columns['year'])))
+                params.append(last)
+    if state['races']:
+        conditions.append(_values_condition(_text_key(columns['race']), state['races'], params))
+    for name, answers in state['flags'].items():
+        conditions.append(_values_condition(_flag_key(columns['flags'][name]), answers, params))
+    return conditions, params
+
+#Indexes for the filters on table: province with the year, race, and for each flag the years of the rows answered Y, which
+#are the few rows a flag is usually filtered for. Those of homicide_news only cover the live rows.
+def create_filter_indexes(cursor, table):
+    columns = sources[table]
+    period = sql.Identifier(columns['date'] or columns['year'])
+    rows = [sql.SQL(columns['rows'])] if columns['rows'] else []
+
+    def create(name, expression, where):
+        where = where + rows
+        cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {name} ON {table} ({expression}){where}").format(
+            name=sql.Identifier(f"{table}_{name}_filter_idx"), table=sql.Identifier(table), expression=expression,
+            where=sql.SQL(" WHERE ") + sql.SQL(' AND ').join(where) if where else sql.SQL('')))
+
+    create('province', sql.SQL("{}, {}").format(_text_key(columns['province']), period), [])
+    create('race', _text_key(columns['race']), [])
+    for name, column in columns['flags'].items():
+        create(name, period, [sql.SQL("{} = 'Y'").format(_flag_key(column))])
+
+#The rows of source matching a filter, grouped by the year and month of death, the chart columns and victim_key, with the
+#number of rows in each group as articles
+def base_result(connection, source, state):
+    columns = sources[source]
+    if columns['date']:
+        date = sql.Identifier(columns['date'])
+        period = [sql.SQL("extract(year FROM {})::int AS year").format(date), sql.SQL("extract(month FROM {})::int AS month").format(date)]
+    else:
+        period = [sql.SQL("{} AS year").format(sql.Identifier(columns['year'])),
+                  sql.SQL("{} AS month").format(sql.Identifier(columns['month']))]
+    selected = period + [sql.SQL("{} AS {}").format(sql.Identifier(column), sql.Identifier(name))
+                         for name, column in columns['columns'].items()] + [sql.SQL("victim_key")]
+    conditions, params = condition(source, state)
+    if columns['rows']:
+        conditions.insert(0, sql.SQL(columns['rows']))
+    query = sql.SQL("SELECT {columns}, COUNT(*) AS articles FROM {table}{where} GROUP BY {group}").format(
+        columns=sql.SQL(', ').join(selected),
+        table=sql.Identifier(source),
+        where=sql.SQL(" WHERE ") + sql.SQL(' AND ').join(conditions) if conditions else sql.SQL(''),
+        group=sql.SQL(', ').join(sql.SQL(str(i + 1)) for i in range(len(selected)))
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    return pd.DataFrame(rows, columns=['year', 'month'] + list(columns['columns']) + ['victim_key', 'articles'])
+
+#Victims of a base result counted by columns, leaving out the rows where any of them is empty
+def victims_by(base, columns, name='count'):
+    data = base[columns + ['victim_key']].replace(r'^\s*$', pd.NA, regex=True).dropna(subset=columns)
+    return data.groupby(columns)['victim_key'].nunique().reset_index(name=name)
+
+#Ages of the victims of a base result, once for each victim
+def victim_ages(base):
+    ages = base.dropna(subset=['age']).drop_duplicates('victim_key')
+    return ages.loc[ages['age'] != -1, ['age']]
@@ -0,0 +1,190 @@
+import threading
+
+from psycopg2 import sql
+
+from incremental_load import archived_columns, key_archive_table
+
+#Removal of exact duplicates from the live (not deleted) rows of homicide_news.
+#The rows to remove are found once with row_number() OVER (PARTITION BY the chosen columns): in every group of rows with the
+#same values the row with the lowest article_id is kept and the others are moved into duplicates. They are moved in batches of
+#batch_size with INSERT ... RETURNING feeding a DELETE, so only the rows that reached duplicates leave homicide_news, each batch
+#in its own short transaction, so other writers are only ever held up by one batch and the progress can be shown while the rest
+#are moved. A row is only moved while the row it duplicates is still there with the same values, so edits made by someone else
+#during the run are respected.
+#Every run is recorded in dedupe_runs, which is updated in the same transaction as each batch.
+
+batch_size = 1000
+
+#Columns that cannot be used to find duplicates, article_id is unique and the others are bookkeeping
+excluded_columns = {'article_id', 'victim_key', 'source_key', 'source_occurrence', 'row_hash', 'deleted_at'}
+
+class DedupeError(Exception):
+    pass
+
+#Check the comma separated column names typed on the Duplicates page against the columns of homicide_news
+def checked_columns(cursor, columns):
+    names = [name.strip() for name in (columns or '').split(',') if name.strip()]
+    if not names:
+        raise DedupeError("Please enter one or more columns to check for duplicates.")
+    cursor.execute("""SELECT column_name FROM information_schema.columns
+                      WHERE table_schema = current_schema() AND table_name = 'homicide_news'""")
+    allowed = {row[0] for row in cursor.fetchall()} - excluded_columns
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise DedupeError(f"Column(s) not found: {', '.join(unknown)}.")
+    return list(dict.fromkeys(names))
+
+def create_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS duplicates (
+            LIKE homicide_news INCLUDING ALL EXCLUDING GENERATED
+        )
+    """)
+    key_archive_table(cursor, 'duplicates')
+    cursor.execute("""CREATE TABLE IF NOT EXISTS dedupe_runs (
+                        run_id SERIAL PRIMARY KEY,
+                        columns TEXT,
+                        groups_found INT DEFAULT 0,
+                        rows_to_move INT DEFAULT 0,
+                        rows_moved INT DEFAULT 0,
+                        status VARCHAR(20) DEFAULT 'running',
+                        message TEXT,
+                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP
+                        )""")
+
+#Groups of rows with the same values in columns, with the number of rows in each
+def duplicate_groups_query(columns):
+    column_list = sql.SQL(', ').join(sql.Identifier(name) for name in columns)
+    return sql.SQL("SELECT {columns}, COUNT(*) FROM homicide_news WHERE deleted_at IS NULL GROUP BY {columns} HAVING COUNT(*) > 1").format(
+        columns=column_list)
+
+#Record a new run for columns and return its run_id
+def start_run(connection, columns):
+    with connection.cursor() as cursor:
+        columns = checked_columns(cursor, columns)
+        create_tables(cursor)
+        cursor.execute("INSERT INTO dedupe_runs (columns) VALUES (%s) RETURNING run_id", (', '.join(columns),))
+        run_id = cursor.fetchone()[0]
+    connection.commit()
+    return run_id
+
+#The row of dedupe_runs for run_id as a dict, None if there is no such run
+def run_status(connection, run_id):
+    with connection.cursor() as cursor:
+        cursor.execute("""SELECT run_id, columns, groups_found, rows_to_move, rows_moved, status, message
+                          FROM dedupe_runs WHERE run_id = %s""", (run_id,))
+        row = cursor.fetchone()
+        names = [column[0] for column in cursor.description]
+    connection.commit()
+    return dict(zip(names, row)) if row else None
+
+#One line describing a run for the dashboards
+def status_message(status):
+    if status is None:
+        return "No duplicate removal is running."
+    if status['status'] == 'running':
+        return (f"Removing duplicates by {status['columns']}: {status['rows_moved']} of {status['rows_to_move']} rows moved "
+                f"into 'duplicates' ({status['groups_found']} groups).")
+    return status['message']
+
+#Move the duplicates by the columns of run_id into duplicates, batch by batch. on_progress(rows_moved, rows_to_move) is
+#called after every batch. Returns the number of rows moved.
+def remove_duplicates(connection, run_id, on_progress=None):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT columns FROM dedupe_runs WHERE run_id = %s", (run_id,))
+        columns = checked_columns(cursor, cursor.fetchone()[0])
+        column_list = sql.SQL(', ').join(sql.Identifier(name) for name in columns)
+        same_values = sql.SQL(' AND ').join(
+            sql.SQL("k.{0} IS NOT DISTINCT FROM h.{0}").format(sql.Identifier(name)) for name in columns
+        )
+        moved = 0
+        try:
+            # The rows to move and the row each of them duplicates, found in one pass over the table
+            cursor.execute("DROP TABLE IF EXISTS dedupe_losers")
+            cursor.execute(sql.SQL("""
+                CREATE TEMP TABLE dedupe_losers AS
+                SELECT article_id, keeper_id FROM (
+                    SELECT article_id,
+                           first_value(article_id) OVER w AS keeper_id,
+                           row_number() OVER w AS position
+                    FROM homicide_news
+                    WHERE deleted_at IS NULL
+                    WINDOW w AS (PARTITION BY {columns} ORDER BY article_id)
+                ) ranked
+                WHERE position > 1""").format(columns=column_list))
+            to_move = cursor.rowcount
+            cursor.execute("CREATE INDEX ON dedupe_losers (article_id)")
+            cursor.execute("SELECT COUNT(DISTINCT keeper_id) FROM dedupe_losers")
+            groups = cursor.fetchone()[0]
+            cursor.execute("UPDATE dedupe_runs SET groups_found = %s, rows_to_move = %s WHERE run_id = %s", (groups, to_move, run_id))
+            connection.commit()
+
+            archive_columns = sql.SQL(', ').join(sql.Identifier(name) for name in archived_columns(cursor))
+            move_batch = sql.SQL("""
+                WITH batch AS (
+                    SELECT article_id, keeper_id FROM dedupe_losers
+                    WHERE article_id > %(last)s
+                    ORDER BY article_id
+                    LIMIT %(batch_size)s
+                ),
+                candidates AS (
+                    SELECT h.article_id FROM homicide_news h
+                    JOIN batch b ON h.article_id = b.article_id
+                    WHERE h.deleted_at IS NULL
+                      AND EXISTS (SELECT 1 FROM homicide_news k
+                                  WHERE k.article_id = b.keeper_id AND k.deleted_at IS NULL AND {same_values})
+                    FOR UPDATE OF h
+                ),
+                archived AS (
+                    INSERT INTO duplicates ({columns})
+                    SELECT {columns} FROM homicide_news WHERE article_id IN (SELECT article_id FROM candidates)
+                    RETURNING article_id
+                ),
+                moved AS (
+                    DELETE FROM homicide_news WHERE article_id IN (SELECT article_id FROM archived)
+                )
+                SELECT (SELECT COUNT(*) FROM archived), (SELECT max(article_id) FROM batch)""").format(
+                same_values=same_values, columns=archive_columns)
+            last = 0
+            while True:
+                cursor.execute(move_batch, {'last': last, 'batch_size': batch_size})
+                batch_moved, last_in_batch = cursor.fetchone()
+                if last_in_batch is None:
+                    break
+                moved += batch_moved
+                last = last_in_batch
+                cursor.execute("UPDATE dedupe_runs SET rows_moved = %s WHERE run_id = %s", (moved, run_id))
+                connection.commit()
+                if on_progress is not None:
+                    on_progress(moved, to_move)
+
+            message = f"{groups} duplicate groups found. {moved} duplicate rows moved from the main table into the 'duplicates' table."
+            cursor.execute("""UPDATE dedupe_runs SET status = 'done', message = %s, finished_at = CURRENT_TIMESTAMP
+                              WHERE run_id = %s""", (message, run_id))
+            cursor.execute("DROP TABLE IF EXISTS dedupe_losers")
+            connection.commit()
+            return moved
+        except Exception as error:
+            connection.rollback()
+            cursor.execute("""UPDATE dedupe_runs SET status = 'failed', message = %s, finished_at = CURRENT_TIMESTAMP
+                              WHERE run_id = %s""",
+                           (f"An error occurred after {moved} rows were moved: {error}", run_id))
+            cursor.execute("DROP TABLE IF EXISTS dedupe_losers")
+            connection.commit()
+            raise
+
+#Run remove_duplicates for run_id on a background thread. connect is a context manager giving a connection (db.get_connection),
+#on_done is called when the run has finished.
+def start_background_run(run_id, connect, on_done=None):
+    def run():
+        try:
+            with connect() as conn:
+                remove_duplicates(conn, run_id)
+        except Exception as error:
+            print(f"Error in remove_duplicates: {error}")
+        finally:
+            if on_done is not None:
+                on_done()
+
+    threading.Thread(target=run, name=f"dedupe-{run_id}", daemon=True).start()
@@ -0,0 +1,140 @@
+import time
+
+from psycopg2 import sql
+
+#Fuzzy duplicate detection for homicide_news.
+#Comparing every row with every other row does not scale, so rows are only compared inside blocks of rows that could be the
+#same victim or the same article:
+#   victims   same province (WC and Western Cape are the same), the same double metaphone code of the surname and a date of
+#             death (or publication when there is none) no more than date_window days apart
+#   articles  the same URL once the scheme, www., query string, fragment and trailing slashes are removed
+#Each pair found is scored from the trigram similarity of the victim names, how close the dates are and whether the URLs match
+#(or otherwise how similar the headlines are). Pairs scoring at least min_score are written to duplicate_candidates, best
+#first, where the Duplicates page pages through them (through the duplicate_candidate_pairs view) and decides what to remove.
+#Uses the pg_trgm and fuzzystrmatch extensions that come with Postgres.
+
+#Days between the dates of two rows for them to be compared as the same victim
+date_window = 7
+
+#Pairs scoring less than this are not kept
+min_score = 0.5
+
+#Weights of the parts of the score, they add up to 1
+name_weight = 0.6
+date_weight = 0.2
+source_weight = 0.2
+
+#Province abbreviations used in the data, so rows are blocked by province whichever spelling they use
+province_codes = {
+    'WC': 'western cape', 'EC': 'eastern cape', 'NC': 'northern cape', 'GP': 'gauteng', 'GT': 'gauteng', 'FS': 'free state',
+    'MP': 'mpumalanga', 'KZN': 'kwazulu-natal', 'LP': 'limpopo', 'NW': 'north west'
+}
+
+#Columns of the duplicate_candidate_pairs view, in the order they are shown
+candidate_columns = [
+    'pair_id', 'score', 'article_id', 'victim_name', 'date_of_death', 'place_of_death_province', 'news_report_url',
+    'other_article_id', 'other_victim_name', 'other_date_of_death', 'other_place_of_death_province', 'other_news_report_url',
+    'name_similarity', 'headline_similarity', 'days_apart', 'same_url'
+]
+
+def create_candidates_table(cursor):
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS fuzzystrmatch")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS duplicate_candidates (
+                        pair_id SERIAL PRIMARY KEY,
+                        article_id INT NOT NULL,
+                        other_article_id INT NOT NULL,
+                        score REAL,
+                        name_similarity REAL,
+                        headline_similarity REAL,
+                        days_apart INT,
+                        same_url BOOLEAN,
+                        found_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE (article_id, other_article_id)
+                        )""")
+    # Pairs whose rows have been removed from homicide_news or deleted since the last run drop out of the view
+    cursor.execute("""CREATE OR REPLACE VIEW duplicate_candidate_pairs AS
+                      SELECT c.pair_id, c.score,
+                             c.article_id, a.victim_name, a.date_of_death, a.place_of_death_province, a.news_report_url,
+                             c.other_article_id, b.victim_name AS other_victim_name, b.date_of_death AS other_date_of_death,
+                             b.place_of_death_province AS other_place_of_death_province, b.news_report_url AS other_news_report_url,
+                             c.name_similarity, c.headline_similarity, c.days_apart, c.same_url
+                      FROM duplicate_candidates c
+                      JOIN homicide_news a ON a.article_id = c.article_id
+                      JOIN homicide_news b ON b.article_id = c.other_article_id
+                      WHERE a.deleted_at IS NULL AND b.deleted_at IS NULL""")
+
+#Blocking and comparison keys of every row of homicide_news, in a temporary table indexed on the blocking keys
+def build_keys(cursor):
+    province_key = sql.SQL("CASE upper(btrim(place_of_death_province)) {} ELSE lower(btrim(coalesce(place_of_death_province, ''))) END").format(
+        sql.SQL(' ').join(sql.SQL("WHEN {} THEN {}").format(sql.Literal(code), sql.Literal(name)) for code, name in province_codes.items())
+    )
+    cursor.execute("DROP TABLE IF EXISTS duplicate_keys")
+    cursor.execute(sql.SQL("""
+        CREATE TEMP TABLE duplicate_keys ON COMMIT DROP AS
+        SELECT article_id, name_key, dmetaphone(coalesce(substring(name_key from '([^ ]+)$'), '')) AS surname_code,
+               province_key, event_date, url_key, headline
+        FROM (
+            SELECT article_id,
+                   btrim(regexp_replace(lower(coalesce(victim_name, '')), '[^[:alnum:]]+', ' ', 'g')) AS name_key,
+                   {province_key} AS province_key,
+                   coalesce(date_of_death, date_of_publication) AS event_date,
+                   regexp_replace(regexp_replace(lower(btrim(coalesce(news_report_url, ''))), '^[a-z]+://(www[.])?', ''), '[?#].*$|/+$', '') AS url_key,
+                   lower(coalesce(news_report_headline, '')) AS headline
+            FROM homicide_news
+            WHERE deleted_at IS NULL
+        ) k""").format(province_key=province_key))
+    cursor.execute("CREATE INDEX ON duplicate_keys (province_key, surname_code, event_date)")
+    cursor.execute("CREATE INDEX ON duplicate_keys (url_key)")
+    cursor.execute("ANALYZE duplicate_keys")
+
+#Find the candidate pairs and replace the contents of duplicate_candidates with them. Returns the number of pairs kept.
+def find_candidates(connection, window=date_window, threshold=min_score):
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        create_candidates_table(cursor)
+        build_keys(cursor)
+        cursor.execute("TRUNCATE duplicate_candidates RESTART IDENTITY")
+        cursor.execute("""
+            WITH pairs AS (
+                SELECT a.article_id AS left_id, b.article_id AS right_id
+                FROM duplicate_keys a
+                JOIN duplicate_keys b ON b.province_key = a.province_key AND b.surname_code = a.surname_code
+                                     AND b.article_id > a.article_id
+                WHERE a.surname_code <> ''
+                  AND (a.event_date IS NULL OR b.event_date IS NULL
+                       OR b.event_date BETWEEN a.event_date - %(window)s AND a.event_date + %(window)s)
+                UNION
+                SELECT a.article_id, b.article_id
+                FROM duplicate_keys a
+                JOIN duplicate_keys b ON b.url_key = a.url_key AND b.article_id > a.article_id
+                WHERE a.url_key <> ''
+            ),
+            compared AS (
+                SELECT p.left_id, p.right_id,
+                       similarity(a.name_key, b.name_key) AS name_similarity,
+                       similarity(a.headline, b.headline) AS headline_similarity,
+                       abs(a.event_date - b.event_date) AS days_apart,
+                       a.url_key <> '' AND a.url_key = b.url_key AS same_url
+                FROM pairs p
+                JOIN duplicate_keys a ON a.article_id = p.left_id
+                JOIN duplicate_keys b ON b.article_id = p.right_id
+            ),
+            scored AS (
+                SELECT *, %(name_weight)s * name_similarity
+                          + %(date_weight)s * CASE WHEN days_apart IS NULL THEN 0.5
+                                                   ELSE greatest(0, 1 - days_apart::real / (%(window)s + 1)) END
+                          + %(source_weight)s * CASE WHEN same_url THEN 1 ELSE headline_similarity END AS score
+                FROM compared
+            )
+            INSERT INTO duplicate_candidates (article_id, other_article_id, score, name_similarity, headline_similarity, days_apart, same_url)
+            SELECT left_id, right_id, score, name_similarity, headline_similarity, days_apart, same_url
+            FROM scored
+            WHERE score >= %(threshold)s
+            ORDER BY score DESC, left_id, right_id""",
+            {'window': window, 'threshold': threshold,
+             'name_weight': name_weight, 'date_weight': date_weight, 'source_weight': source_weight})
+        found = cursor.rowcount
+    connection.commit()
+    print(f"{found} likely duplicate pair(s) found in homicide_news ({time.perf_counter() - started:.1f}s).")
+    return found
@@ -0,0 +1,317 @@
+import os
+import queue
+import tempfile
+import threading
+import zlib
+
+from psycopg2 import sql
+
+#Streaming CSV export.
+#COPY ... TO STDOUT runs on a background thread and hands its output over in chunks through a small bounded queue, so the
+#web process only ever holds a few chunks of the table at a time. The chunks can be gzip compressed on the way out.
+
+#Tables that can be exported
+exportable_tables = ['homicide_news', 'open_day_homicide_data', 'homicide_complete']
+
+#Columns that only exist for the database's own bookkeeping and are left out of exports
+internal_columns = {'victim_key', 'source_key', 'source_occurrence', 'row_hash', 'deleted_at'}
+
+#Condition on the rows exported from tables whose deleted rows stay in the table (see bulk_delete.py)
+exported_rows = {'homicide_news': sql.SQL('deleted_at IS NULL')}
+
+#Size of the chunks handed to the response, and how many chunks may wait in the queue
+chunk_size = 64 * 1024
+queued_chunks = 8
+
+class ExportCancelled(Exception):
+    pass
+
+#File object given to copy_expert: collects what COPY writes into chunks and puts them on the queue.
+#put blocks while the queue is full, so COPY only runs as fast as the response is sent.
+class _QueueWriter:
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer += data
+        if len(self.buffer) >= chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk, self.buffer = bytes(self.buffer), bytearray()
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+#The columns of table in table order, without the internal ones
+def export_columns(cursor, table):
+    cursor.execute("""SELECT column_name FROM information_schema.columns
+                      WHERE table_schema = current_schema() AND table_name = %s
+                      ORDER BY ordinal_position""", (table,))
+    return [row[0] for row in cursor.fetchall() if row[0] not in internal_columns]
+
+#COPY statement writing table as CSV with a header row
+def copy_statement(cursor, table):
+    if table not in exportable_tables:
+        raise ValueError(f"{table} cannot be exported.")
+    columns = export_columns(cursor, table)
+    if not columns:
+        raise ValueError(f"Table {table} does not exist.")
+    return sql.SQL("COPY (SELECT {columns} FROM {table} WHERE {rows}) TO STDOUT WITH CSV HEADER").format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(', ').join(sql.Identifier(col) for col in columns),
+        rows=exported_rows.get(table, sql.SQL('TRUE'))
+    )
+
+#Generate table as CSV (UTF-8) in chunks of bytes, gzip compressed when compress is set.
+#connection is only used by this export until the generator finishes or is closed. When it is closed before the end (the client
+#went away) the COPY is cancelled on the server, and the connection is left in a failed transaction for the caller to discard.
+def stream_csv(connection, table, compress=False):
+    cursor = connection.cursor()
+    statement = copy_statement(cursor, table)
+    chunks = queue.Queue(maxsize=queued_chunks)
+    cancelled = threading.Event()
+    errors = []
+    done = object()
+
+    def produce():
+        writer = _QueueWriter(chunks, cancelled)
+        try:
+            cursor.copy_expert(statement, writer)
+            writer.flush()
+        except Exception as error:
+            errors.append(error)
+        finally:
+            while True:
+                try:
+                    chunks.put(done, timeout=1)
+                    break
+                except queue.Full:
+                    if cancelled.is_set():
+                        break
+
+    producer = threading.Thread(target=produce, name=f"export-{table}", daemon=True)
+    producer.start()
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    finished = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        producer.join()
+        if errors:
+            raise errors[0]
+        if compressor is not None:
+            yield compressor.flush()
+        finished = True
+    finally:
+        # The client went away or something failed: stop COPY on the server and let the producer finish
+        cancelled.set()
+        if not finished and producer.is_alive():
+            connection.cancel()
+        while producer.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        cursor.close()
+
+#Write table as CSV into an anonymous temporary file and return it, positioned at the start.
+#For callers that need a file rather than a stream (the Streamlit download button).
+def export_to_tempfile(connection, table, compress=False):
+    export_file = tempfile.TemporaryFile()
+    for chunk in stream_csv(connection, table, compress):
+        export_file.write(chunk)
+    export_file.seek(0)
+    return export_file
+
+#---------------------------------------------------------------------------------------------------------------------------
+#Columnar export.
+#The table is read through a server side cursor in batches of batch_size rows and written batch by batch as Parquet or as an
+#Arrow IPC file, keeping the column types: dates stay dates, integers stay integers, and the low cardinality text columns
+#(Y/N/U flags, provinces, races, ...) are dictionary encoded. Arrow files are written uncompressed by default so they can be
+#memory mapped and read without copying.
+
+columnar_formats = {'parquet': 'application/vnd.apache.parquet', 'arrow': 'application/vnd.apache.arrow.file'}
+
+batch_size = 50000
+
+#Columns written dictionary encoded, compared after lower casing and keeping only letters and digits so they match in every table
+dictionary_columns = {
+    'province', 'place of death province', 'race', 'race of victim', 'news report platform', 'wire service', 'sapa wire',
+    'type of location', 'location home public work unknown', 'sexual assault', 'robbery', 'robbery y n u', 'mode of death',
+    'mode of death specific', 'suspect arrested', 'suspect convicted', 'suspect gender', 'multiple murder',
+    'intimate femicide', 'intimate femicide y n u', 'extreme violence', 'extreme violence y n m u', 'month',
+    'vic susp relationship', 'perpetrator relationship to victim'
+}
+
+def _normalise(name):
+    return ' '.join(''.join(ch if ch.isalnum() else ' ' for ch in name.lower()).split())
+
+#Arrow type for a Postgres data_type, anything not listed is written as text
+def _arrow_type(pa, data_type):
+    return {
+        'smallint': pa.int16(),
+        'integer': pa.int32(),
+        'bigint': pa.int64(),
+        'real': pa.float32(),
+        'double precision': pa.float64(),
+        'numeric': pa.float64(),
+        'boolean': pa.bool_(),
+        'date': pa.date32(),
+        'timestamp without time zone': pa.timestamp('us'),
+        'timestamp with time zone': pa.timestamp('us', tz='UTC')
+    }.get(data_type, pa.string())
+
+#Builds the dictionary of one column across every batch. The dictionary only ever grows, so each batch can be written as a
+#delta of the one before, which the Arrow IPC file format requires.
+class _DictionaryColumn:
+    def __init__(self, pa):
+        self.pa = pa
+        self.positions = {}
+
+    def encode(self, values):
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            value = str(value)
+            position = self.positions.get(value)
+            if position is None:
+                position = self.positions[value] = len(self.positions)
+            indices.append(position)
+        return self.pa.DictionaryArray.from_arrays(
+            self.pa.array(indices, type=self.pa.int32()),
+            self.pa.array(list(self.positions), type=self.pa.string())
+        )
+
+#Names and data types of the columns of table that are exported
+def export_column_types(cursor, table):
+    if table not in exportable_tables:
+        raise ValueError(f"{table} cannot be exported.")
+    cursor.execute("""SELECT column_name, data_type FROM information_schema.columns
+                      WHERE table_schema = current_schema() AND table_name = %s
+                      ORDER BY ordinal_position""", (table,))
+    columns = [(name, data_type) for name, data_type in cursor.fetchall() if name not in internal_columns]
+    if not columns:
+        raise ValueError(f"Table {table} does not exist.")
+    return columns
+
+#Write table to sink (a path or a binary file object) as 'parquet' or 'arrow'. Returns the number of rows written.
+#compression is passed to the writer: Parquet defaults to snappy, Arrow files to no compression.
+def write_columnar(connection, table, sink, fmt='parquet', compression=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt not in columnar_formats:
+        raise ValueError(f"Unknown export format: {fmt}")
+    with connection.cursor() as cursor:
+        columns = export_column_types(cursor, table)
+
+    fields = []
+    converters = []
+    for name, data_type in columns:
+        arrow_type = _arrow_type(pa, data_type)
+        if arrow_type == pa.string() and _normalise(name) in dictionary_columns:
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+            converters.append(_DictionaryColumn(pa).encode)
+        elif arrow_type == pa.string():
+            fields.append(pa.field(name, arrow_type))
+            converters.append(lambda values, arrow_type=arrow_type: pa.array([None if v is None else str(v) for v in values], type=arrow_type))
+        elif data_type in ('numeric', 'real', 'double precision'):
+            fields.append(pa.field(name, arrow_type))
+            converters.append(lambda values, arrow_type=arrow_type: pa.array([None if v is None else float(v) for v in values], type=arrow_type))
+        else:
+            fields.append(pa.field(name, arrow_type))
+            converters.append(lambda values, arrow_type=arrow_type: pa.array(values, type=arrow_type))
+    schema = pa.schema(fields)
+
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression=compression or 'snappy')
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch], schema=schema))
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=compression, emit_dictionary_deltas=True)
+        writer = pa.ipc.new_file(sink, schema, options=options)
+        write = writer.write_batch
+
+    rows_written = 0
+    select = sql.SQL("SELECT {columns} FROM {table} WHERE {rows}").format(
+        columns=sql.SQL(', ').join(sql.Identifier(name) for name, _ in columns),
+        table=sql.Identifier(table),
+        rows=exported_rows.get(table, sql.SQL('TRUE'))
+    )
+    try:
+        # A named cursor keeps the result on the server, only batch_size rows are in memory at a time
+        with connection.cursor(name=f"export_{table}") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(select)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                values = list(zip(*rows))
+                arrays = [convert(list(column)) for convert, column in zip(converters, values)]
+                write(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                rows_written += len(rows)
+    finally:
+        writer.close()
+    return rows_written
+
+#Write table as Parquet or Arrow into an anonymous temporary file and return it, positioned at the start
+def columnar_tempfile(connection, table, fmt='parquet', compression=None):
+    export_file = tempfile.TemporaryFile()
+    write_columnar(connection, table, export_file, fmt, compression)
+    export_file.seek(0)
+    return export_file
+
+#Write a snapshot of every exportable table into directory as <table>.<fmt>
+def write_snapshot(connection, directory, fmt='parquet', compression=None):
+    os.makedirs(directory, exist_ok=True)
+    written = {}
+    for table in exportable_tables:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", (table,))
+            if cursor.fetchone()[0] is None:
+                print(f"Skipping {table}, it does not exist.")
+                continue
+        path = os.path.join(directory, f"{table}.{fmt}")
+        written[table] = write_columnar(connection, table, path, fmt, compression)
+        connection.commit()
+        print(f"{table}: {written[table]} rows written to {path} ({os.path.getsize(path) / 1e6:.1f} MB).")
+    return written
+
+if __name__ == "__main__":
+    import argparse
+
+    import psycopg2
+
+    from config import config
+
+    parser = argparse.ArgumentParser(description="Write a Parquet or Arrow snapshot of the homicide tables.")
+    parser.add_argument('directory', help="directory the files are written to")
+    parser.add_argument('--format', choices=list(columnar_formats), default='parquet')
+    parser.add_argument('--compression', help="e.g. snappy, zstd or gzip for parquet, lz4 or zstd for arrow")
+    args = parser.parse_args()
+    connection = psycopg2.connect(**config())
+    try:
+        write_snapshot(connection, args.directory, args.format, args.compression)
+    finally:
+        connection.close()
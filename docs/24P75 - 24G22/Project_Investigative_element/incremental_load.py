@@ -0,0 +1,152 @@
+import time
+
+from xlsx_load import copy_from_xlsx, is_workbook
+
+#Incremental load of the CSV files into tables that already exist.
+#Every row loaded from a CSV file carries three extra columns:
+#   source_key         md5 of the columns that identify the row in the file (see identity_columns)
+#   source_occurrence  1 for the first row in the file with that source_key, 2 for the second and so on, so repeated rows are kept
+#   row_hash           md5 of every column loaded from the file, as it was when the row was last loaded
+#The file is copied into a temporary staging table and merged with one INSERT ... ON CONFLICT: new rows are inserted, rows whose
+#row_hash changed are updated and the rest are skipped. A row edited in the dashboard keeps the edit until the file changes that row.
+#Rows removed in the dashboard (deleted, which keeps them in the table with deleted_at set, or moved into duplicates or
+#delete_dash) are not inserted again, and nothing is ever deleted.
+
+#Columns identifying a row of each table in its CSV file
+identity_columns = {
+    'homicide_news': ['news_report_url', 'news_report_headline', 'victim_name'],
+    'open_day_homicide_data': ['"MEDIA COVERAGE URL OR NAME"', '"DATE OF ARTICLE"', '"VICTIM NAME"']
+}
+
+#Tables the dashboard moves rows into when it removes them from the live table
+archive_tables = {
+    'homicide_news': ['duplicates', 'delete_dash'],
+    'open_day_homicide_data': []
+}
+
+def source_key_expression(table, alias):
+    parts = ', '.join(f"lower(btrim(coalesce({alias}.{col}::text, '')))" for col in identity_columns[table])
+    return f"md5(concat_ws('|', {parts}))"
+
+def row_hash_expression(columns, alias):
+    return f"md5(ROW({', '.join(f'{alias}.{col}' for col in columns)})::text)"
+
+#Add the source columns to a table (and the archive tables) created before incremental loads existed
+def add_source_columns(cursor, table):
+    for name in [table] + archive_tables[table]:
+        cursor.execute(f"""ALTER TABLE IF EXISTS {name}
+                            ADD COLUMN IF NOT EXISTS source_key VARCHAR(32),
+                            ADD COLUMN IF NOT EXISTS source_occurrence INT,
+                            ADD COLUMN IF NOT EXISTS row_hash VARCHAR(32)""")
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_source_key_idx ON {table} (source_key, source_occurrence)")
+
+#The archive tables were created with LIKE homicide_news, so they were keyed by article_id like the live table. A full load by
+#main.py numbers the live rows from 1 again but keeps the archives, so a row archived after a reload can have the article_id of
+#one archived before it. The archive is given an archive_id of its own as its key instead, and the unique constraints and
+#indexes it copied are dropped, keeping a plain index on the source key for merge_stage.
+def key_archive_table(cursor, name):
+    cursor.execute("""SELECT column_name FROM information_schema.columns
+                      WHERE table_schema = current_schema() AND table_name = %s""", (name,))
+    names = {row[0] for row in cursor.fetchall()}
+    if 'archive_id' in names:
+        return
+    cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('p', 'u')", (name,))
+    for (constraint,) in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {name} DROP CONSTRAINT "{constraint}"')
+    cursor.execute("""SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+                      WHERE x.indrelid = %s::regclass AND x.indisunique""", (name,))
+    for (index,) in cursor.fetchall():
+        cursor.execute(f'DROP INDEX "{index}"')
+    cursor.execute(f"ALTER TABLE {name} ADD COLUMN archive_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY")
+    if {'source_key', 'source_occurrence'} <= names:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name}_source_key_idx ON {name} (source_key, source_occurrence)")
+
+#Columns of homicide_news in table order, the columns a row is archived with
+def archived_columns(cursor):
+    cursor.execute("""SELECT column_name FROM information_schema.columns
+                      WHERE table_schema = current_schema() AND table_name = 'homicide_news'
+                      ORDER BY ordinal_position""")
+    return [row[0] for row in cursor.fetchall()]
+
+#Give the rows that have no source_key yet (loaded before incremental loads existed, or entered in the dashboard) their key and hash,
+#numbering them after the rows that already have the same key
+def backfill_source_keys(cursor, table, columns):
+    cursor.execute(f"""
+        UPDATE {table} t
+        SET source_key = k.source_key, source_occurrence = k.source_occurrence, row_hash = k.row_hash
+        FROM (
+            SELECT n.article_id, n.source_key, n.row_hash,
+                   coalesce(m.last_occurrence, 0) + row_number() OVER (PARTITION BY n.source_key ORDER BY n.article_id) AS source_occurrence
+            FROM (
+                SELECT t.article_id, {source_key_expression(table, 't')} AS source_key, {row_hash_expression(columns, 't')} AS row_hash
+                FROM {table} t
+                WHERE t.source_key IS NULL
+            ) n
+            LEFT JOIN (
+                SELECT source_key, max(source_occurrence) AS last_occurrence
+                FROM {table}
+                WHERE source_key IS NOT NULL
+                GROUP BY source_key
+            ) m ON m.source_key = n.source_key
+        ) k
+        WHERE t.article_id = k.article_id""")
+    return cursor.rowcount
+
+#Copy the CSV file (or a sheet of a workbook) into a temporary table shaped like the columns it fills, keeping the order of the rows in the file
+def stage_csv(cursor, table, columns, csv_file_path, sheet=None):
+    cursor.execute("DROP TABLE IF EXISTS incremental_stage")
+    cursor.execute(f"CREATE TEMP TABLE incremental_stage ON COMMIT DROP AS SELECT {', '.join(columns)} FROM {table} WITH NO DATA")
+    cursor.execute("ALTER TABLE incremental_stage ADD COLUMN line_no BIGINT GENERATED ALWAYS AS IDENTITY")
+    if is_workbook(csv_file_path):
+        return copy_from_xlsx(cursor, 'incremental_stage', columns, csv_file_path, sheet)
+    with open(csv_file_path, 'r', encoding='ISO-8859-1') as file:
+        cursor.execute('SET datestyle = "ISO, DMY";')
+        cursor.copy_expert(f"""COPY incremental_stage ({', '.join(columns)})
+        FROM STDIN WITH CSV HEADER DELIMITER ';'""", file)
+    return cursor.rowcount
+
+#Merge the staging table into the live table in one statement and return the number of rows inserted and updated
+def merge_stage(cursor, table, columns):
+    cursor.execute("SELECT name FROM unnest(%s::text[]) AS name WHERE to_regclass(name) IS NOT NULL", (archive_tables[table],))
+    archives = [row[0] for row in cursor.fetchall()]
+    removed = ''.join(f"""
+              AND NOT EXISTS (SELECT 1 FROM {name} a
+                              WHERE a.source_key = s.source_key AND a.source_occurrence = s.source_occurrence)"""
+                      for name in archives)
+    column_list = ', '.join(columns)
+    cursor.execute(f"""
+        WITH source AS (
+            SELECT {column_list}, source_key, row_hash,
+                   row_number() OVER (PARTITION BY source_key ORDER BY line_no) AS source_occurrence
+            FROM (
+                SELECT s.*, {source_key_expression(table, 's')} AS source_key, {row_hash_expression(columns, 's')} AS row_hash
+                FROM incremental_stage s
+            ) s
+        ),
+        merged AS (
+            INSERT INTO {table} AS t ({column_list}, source_key, source_occurrence, row_hash)
+            SELECT {column_list}, source_key, source_occurrence, row_hash
+            FROM source s
+            WHERE EXISTS (SELECT 1 FROM {table} l
+                          WHERE l.source_key = s.source_key AND l.source_occurrence = s.source_occurrence)
+               OR (TRUE{removed})
+            ON CONFLICT (source_key, source_occurrence) DO UPDATE
+            SET {', '.join(f'{col} = EXCLUDED.{col}' for col in columns)}, row_hash = EXCLUDED.row_hash
+            WHERE t.row_hash IS DISTINCT FROM EXCLUDED.row_hash
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged""")
+    return cursor.fetchone()
+
+#Load a CSV file into an existing table, only writing the rows that are new or changed. Runs in the caller's transaction.
+def incremental_load(cursor, table, columns, csv_file_path, sheet=None):
+    started = time.perf_counter()
+    add_source_columns(cursor, table)
+    backfilled = backfill_source_keys(cursor, table, columns)
+    if backfilled:
+        print(f"{backfilled} existing row(s) in {table} given a source key.")
+    staged = stage_csv(cursor, table, columns, csv_file_path, sheet)
+    inserted, updated = merge_stage(cursor, table, columns)
+    elapsed = time.perf_counter() - started
+    print(f"{table}: {staged} rows read, {inserted} inserted, {updated} updated, {staged - inserted - updated} unchanged or removed ({elapsed:.1f}s).")
+    return inserted, updated
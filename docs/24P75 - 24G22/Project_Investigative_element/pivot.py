@@ -0,0 +1,218 @@
+import hashlib
+import json
+
+import pandas as pd
+from psycopg2 import sql
+
+import cross_filter
+
+#Aggregation engine behind the Custom Data Visualization pages.
+#A pivot is described by a spec, a plain dict that can be kept in a dcc.Store or st.session_state:
+#   {'source': 'open_day_homicide_data',
+#    'dimensions': ['province', 'race'],              columns to group by, by the names in sources
+#    'measures': ['victims', 'mean_age'],             see measures
+#    'time_bucket': 'year',                           group the date of death by day, week, month, quarter or year
+#    'filters': [['province', 'in', ['WC', 'GP']],    dimension (or 'date'), operator and value
+#                ['date', 'between', ['2015-01-01', '2019-12-31']]],
+#    'scope': {'provinces': ['gauteng']}}            the global filter of the dashboards, see cross_filter.py
+#Dimensions and measures are looked up in the whitelists below, so nothing typed by the user becomes an identifier, and the spec
+#is compiled into one statement with every filter value passed as a parameter. Specs are normalised before they are run, so
+#spec_hash gives the same key for the same pivot however it was put together and results can be cached by it.
+
+#Dimensions of each table that can be grouped and filtered by, their columns and the date column used for time buckets.
+#The same names are used for both tables, so a spec only needs its source changed to run against the other one.
+sources = {
+    'open_day_homicide_data': {
+        'dimensions': {
+            'province': 'province', 'city': 'CITY/AREA', 'race': 'race', 'age': 'age', 'occupation': 'occupation',
+            'location': 'LOCATION (HOME/PUBLIC/WORK/UNKNOWN)', 'mode_of_death': 'MODE OF DEATH',
+            'relationship': 'VIC SUSP RELATIONSHIP', 'suspect_gender': 'SUSPECT GENDER', 'suspect_arrested': 'SUSPECT ARRESTED',
+            'suspect_convicted': 'SUSPECT CONVICTED', 'sexual_assault': 'SEXUAL ASSAULT', 'robbery': 'robbery',
+            'intimate_femicide': 'INTIMATE FEMICIDE', 'multiple_murder': 'MULTIPLE MURDER', 'extreme_violence': 'EXTREME VIOLENCE',
+            'year': 'year'
+        },
+        'date': 'death_date',
+        'age': 'age',
+        # the open day data records an unknown age as -1
+        'unknown_age': -1,
+        'rows': None
+    },
+    'homicide_news': {
+        'dimensions': {
+            'province': 'place_of_death_province', 'town': 'place_of_death_town', 'race': 'race_of_victim', 'age': 'age_of_victim',
+            'location': 'type_of_location', 'mode_of_death': 'mode_of_death_specific',
+            'relationship': 'perpetrator_relationship_to_victim', 'suspect_arrested': 'suspect_arrested',
+            'suspect_convicted': 'suspect_convicted', 'sexual_assault': 'sexual_assault', 'robbery': 'robbery_y_n_u',
+            'intimate_femicide': 'intimate_femicide_y_n_u', 'multiple_murder': 'multiple_murder',
+            'extreme_violence': 'extreme_violence_y_n_m_u', 'platform': 'news_report_platform', 'wire_service': 'wire_service'
+        },
+        'date': 'date_of_death',
+        'age': 'age_of_victim',
+        'unknown_age': None,
+        # deleted rows stay in homicide_news until they are purged (see bulk_delete.py)
+        'rows': 'deleted_at IS NULL'
+    }
+}
+
+default_source = 'open_day_homicide_data'
+
+#Measure: (label, SQL with {age} standing for the age column of the source, NULL where it holds the source's unknown_age).
+#share is each group's part of the victims counted over all the groups returned.
+measures = {
+    'victims': ("Victims", "COUNT(DISTINCT victim_key)"),
+    'articles': ("Articles", "COUNT(*)"),
+    'mean_age': ("Mean age", "round(avg({age})::numeric, 1)"),
+    'share': ("Share of victims (%)",
+              "round(100.0 * COUNT(DISTINCT victim_key) / NULLIF(sum(COUNT(DISTINCT victim_key)) OVER (), 0), 1)")
+}
+
+time_buckets = ['day', 'week', 'month', 'quarter', 'year']
+
+#Filter operators and the number of values they take, None for a list of any length
+filter_operators = {'=': 1, '!=': 1, '<': 1, '<=': 1, '>': 1, '>=': 1, 'between': 2, 'in': None, 'not in': None}
+
+#Most groups returned by one pivot
+max_groups = 5000
+
+class SpecError(ValueError):
+    pass
+
+def dimension_label(name):
+    return name.replace('_', ' ').capitalize()
+
+#Check a spec against the whitelists and return it in its canonical form
+def normalise(spec):
+    spec = spec or {}
+    source = spec.get('source') or default_source
+    if source not in sources:
+        raise SpecError(f"Unknown source: {source}.")
+    dimensions = sources[source]['dimensions']
+
+    chosen = list(dict.fromkeys(spec.get('dimensions') or []))
+    for name in chosen:
+        if name not in dimensions:
+            raise SpecError(f"Unknown dimension: {name}.")
+    chosen_measures = list(dict.fromkeys(spec.get('measures') or ['victims']))
+    for name in chosen_measures:
+        if name not in measures:
+            raise SpecError(f"Unknown measure: {name}.")
+    time_bucket = spec.get('time_bucket') or None
+    if time_bucket is not None and time_bucket not in time_buckets:
+        raise SpecError(f"Unknown time bucket: {time_bucket}.")
+
+    filters = []
+    for dimension, operator, value in spec.get('filters') or []:
+        if dimension != 'date' and dimension not in dimensions:
+            raise SpecError(f"Unknown dimension in filter: {dimension}.")
+        if operator not in filter_operators:
+            raise SpecError(f"Unknown filter operator: {operator}.")
+        count = filter_operators[operator]
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+        values = [str(item).strip() for item in values if item is not None and str(item).strip() != '']
+        if not values:
+            continue
+        if count is not None and len(values) != count:
+            raise SpecError(f"'{operator}' takes {count} value(s), {len(values)} given for {dimension}.")
+        filters.append([dimension, operator, values if count is None or count > 1 else values[0]])
+    filters.sort(key=lambda item: json.dumps(item))
+
+    try:
+        scope = cross_filter.normalise(spec.get('scope'))
+    except cross_filter.FilterError as error:
+        raise SpecError(str(error))
+
+    return {'source': source, 'dimensions': chosen, 'measures': chosen_measures, 'time_bucket': time_bucket, 'filters': filters,
+            'scope': scope}
+
+#Key identifying a pivot, the same for every spec that normalises to the same thing
+def spec_hash(spec):
+    canonical = json.dumps(normalise(spec), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+#The statement, its parameters and the names of the result columns for a spec
+def compile_spec(spec):
+    spec = normalise(spec)
+    source = sources[spec['source']]
+    params = []
+
+    groups = []
+    names = []
+    if spec['time_bucket']:
+        groups.append(sql.SQL("date_trunc(%s, {})::date AS period").format(sql.Identifier(source['date'])))
+        params.append(spec['time_bucket'])
+        names.append('period')
+    for name in spec['dimensions']:
+        groups.append(sql.SQL("{} AS {}").format(sql.Identifier(source['dimensions'][name]), sql.Identifier(name)))
+        names.append(name)
+    age = sql.Identifier(source['age'])
+    if source['unknown_age'] is not None:
+        age = sql.SQL("NULLIF({}, {})").format(age, sql.Literal(source['unknown_age']))
+    aggregates = [sql.SQL(measures[name][1] + " AS {name}").format(age=age, name=sql.Identifier(name)) for name in spec['measures']]
+
+    conditions = [sql.SQL(source['rows'])] if source['rows'] else []
+    for dimension, operator, value in spec['filters']:
+        column = sql.Identifier(source['date'] if dimension == 'date' else source['dimensions'][dimension])
+        if operator == 'between':
+            conditions.append(sql.SQL("{} BETWEEN %s AND %s").format(column))
+            params.extend(value)
+        elif operator in ('in', 'not in'):
+            # compared as text so a list of values works for every column type
+            conditions.append(sql.SQL("{}::text " + ("= ANY(%s)" if operator == 'in' else "<> ALL(%s)")).format(column))
+            params.append(value)
+        else:
+            conditions.append(sql.SQL("{} " + operator + " %s").format(column))
+            params.append(value)
+    scope_conditions, scope_params = cross_filter.condition(spec['source'], spec['scope'])
+    conditions.extend(scope_conditions)
+    params.extend(scope_params)
+
+    query = sql.SQL("SELECT {columns} FROM {table}{where}{group} ORDER BY {order} LIMIT %s").format(
+        columns=sql.SQL(', ').join(groups + aggregates),
+        table=sql.Identifier(spec['source']),
+        where=sql.SQL(" WHERE ") + sql.SQL(' AND ').join(conditions) if conditions else sql.SQL(''),
+        group=sql.SQL(" GROUP BY ") + sql.SQL(', ').join(sql.SQL(str(i + 1)) for i in range(len(groups))) if groups else sql.SQL(''),
+        order=sql.SQL(', ').join(sql.SQL(str(i + 1)) for i in range(len(groups))) if groups else sql.SQL('1')
+    )
+    params.append(max_groups)
+    return query, params, names + spec['measures']
+
+#Run a spec on a psycopg2 connection and return the result as a DataFrame
+def run(connection, spec):
+    query, params, columns = compile_spec(spec)
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    result = pd.DataFrame(rows, columns=columns)
+    # round() gives Decimals, the charts need numbers
+    for name in columns:
+        if name in measures:
+            result[name] = pd.to_numeric(result[name])
+    return result
+
+#Chart of a pivot: a line over time when it has a time bucket, otherwise bars, coloured by the next dimension and split into
+#side by side charts by the one after that. Only the first measure is drawn, the others are in the table next to it.
+def figure(result, spec):
+    # imported here so the dashboards do not load plotly.express until the first chart is drawn
+    import plotly.express as px
+
+    spec = normalise(spec)
+    measure = spec['measures'][0]
+    label = measures[measure][0]
+    axes = (['period'] if spec['time_bucket'] else []) + spec['dimensions']
+    labels = {measure: label, 'period': (spec['time_bucket'] or '').capitalize()}
+    labels.update({name: dimension_label(name) for name in spec['dimensions']})
+    if not axes:
+        totals = pd.DataFrame({'measure': [measures[name][0] for name in spec['measures']],
+                               'value': [result[name].iloc[0] if len(result) else 0 for name in spec['measures']]})
+        return px.bar(totals, x='measure', y='value', title="Totals")
+    x = axes[0]
+    color = axes[1] if len(axes) > 1 else None
+    facet = axes[2] if len(axes) > 2 else None
+    data = result.copy()
+    for name in axes[1:]:
+        data[name] = data[name].astype(str)
+    title = f"{label} by {', '.join(labels[name] for name in axes)}"
+    if spec['time_bucket']:
+        return px.line(data, x=x, y=measure, color=color, facet_col=facet, markers=True, labels=labels, title=title)
+    data[x] = data[x].astype(str)
+    return px.bar(data, x=x, y=measure, color=color, facet_col=facet, barmode='group', labels=labels, title=title)
@@ -0,0 +1,247 @@
+import csv
+import io
+import re
+from array import array
+
+import psycopg2
+from psycopg2 import sql
+
+import validation
+from xlsx_load import RowStream
+
+#Bulk upload of a semicolon separated CSV file into a table with COPY FROM STDIN.
+#The header is checked against the table before anything is written. Rows with the wrong number of fields, and rows failing
+#the checks in validation.py, are rejected and written to a rejects report with their line numbers, and the remaining rows go
+#to the table in a single COPY inside one transaction: either every accepted row is inserted or, if the database refuses one, none are.
+
+#Tables the dashboards upload into
+upload_tables = ['homicide_news', 'homicide_complete']
+
+#How much of the file is looked at to decide between UTF-8 and ISO-8859-1
+encoding_sample_size = 64 * 1024
+
+class UploadError(Exception):
+    pass
+
+#Result of an upload, turned into the message shown in the dashboards by str()
+class UploadResult:
+    def __init__(self, table, inserted, report):
+        self.table = table
+        self.inserted = inserted
+        self.rejected = report.rows_rejected
+        self.problems = report.problems
+        self.examples = report.examples
+
+    def __str__(self):
+        message = f"{self.inserted} row(s) inserted into {self.table}, {self.rejected} rejected."
+        if self.examples:
+            shown = '; '.join(f"line {line}: {problem}" for line, problem, _ in self.examples[:10])
+            more = f" (and {self.problems - 10} more)" if self.problems > 10 else ''
+            message += f" Problems found: {shown}{more}."
+        return message
+
+#UTF-8 if the start of the file decodes as UTF-8, otherwise ISO-8859-1 which is what the project's CSV files use
+def detect_encoding(binary_file):
+    position = binary_file.tell()
+    sample = binary_file.read(encoding_sample_size)
+    binary_file.seek(position)
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as error:
+        # a multi-byte character cut off at the end of the sample is still UTF-8
+        if error.start < len(sample) - 3:
+            return 'ISO-8859-1'
+    return 'utf-8-sig'
+
+#Names, whether they can be written, of the columns of table in table order. Empty when the table does not exist.
+def table_columns(cursor, table):
+    cursor.execute("""SELECT column_name, is_generated = 'ALWAYS' OR is_identity = 'YES' AND identity_generation = 'ALWAYS'
+                      FROM information_schema.columns
+                      WHERE table_schema = current_schema() AND table_name = %s
+                      ORDER BY ordinal_position""", (table,))
+    return cursor.fetchall()
+
+#Match the header of the file to the columns of the table, ignoring case and surrounding spaces.
+#Raises UploadError listing every header that does not match a column that can be written.
+def map_header(header, columns):
+    writable = {name.lower(): name for name, generated in columns if not generated}
+    generated = {name.lower() for name, is_generated in columns if is_generated}
+    mapped = []
+    problems = []
+    for name in header:
+        key = name.strip().lower()
+        if key in generated:
+            problems.append(f"'{name}' is filled in by the database")
+        elif key not in writable:
+            problems.append(f"'{name}' is not a column of the table")
+        elif writable[key] in mapped:
+            problems.append(f"'{name}' appears more than once")
+        else:
+            mapped.append(writable[key])
+    if problems:
+        raise UploadError("The header does not match the table: " + ', '.join(problems) + ".")
+    return mapped
+
+#Create table with a TEXT column for every header, for uploads into a table that does not exist yet
+def create_text_table(cursor, table, header):
+    names = [name.strip() for name in header]
+    if any(not name for name in names) or len(set(n.lower() for n in names)) != len(names):
+        raise UploadError("Every column in the header needs a unique name.")
+    cursor.execute(sql.SQL("CREATE TABLE {} ({})").format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(sql.SQL("{} TEXT").format(sql.Identifier(name)) for name in names)
+    ))
+
+#Rows of the file with the right number of fields that pass validation, checked a batch at a time.
+#Records the line number of each accepted row, rejected rows go to the report. Blank fields, which validation treats as empty
+#whatever the column's type, are given as None so COPY reads them as NULL instead of trying to read "  " as a number or date.
+class _AcceptedRows:
+    def __init__(self, reader, validator, report):
+        self.reader = reader
+        self.validator = validator
+        self.width = len(validator.columns)
+        self.report = report
+        self.lines = array('l')
+
+    def _checked(self, batch, lines):
+        accepted = self.validator.check(batch, lines, self.report)
+        for row, line, ok in zip(batch, lines, accepted):
+            if ok:
+                self.lines.append(line)
+                yield [field if field.strip() else None for field in row]
+
+    def __iter__(self):
+        batch = []
+        lines = []
+        while True:
+            # line the row starts on, a quoted field can carry it over several lines
+            line = self.reader.line_num + 1
+            try:
+                row = next(self.reader)
+            except StopIteration:
+                break
+            except csv.Error as error:
+                self.report.reject_row(line, str(error))
+                continue
+            if not row or not any(field.strip() for field in row):
+                continue
+            if len(row) != self.width:
+                self.report.reject_row(line, f"{len(row)} fields, expected {self.width}")
+                continue
+            batch.append(row)
+            lines.append(line)
+            if len(batch) >= validation.batch_size:
+                yield from self._checked(batch, lines)
+                batch = []
+                lines = []
+        yield from self._checked(batch, lines)
+
+#Line of the uploaded file the database refused, from the 'COPY table, line N' context of its error
+def _failed_line(error, lines):
+    context = getattr(getattr(error, 'diag', None), 'context', None) or ''
+    match = re.search(r'line (\d+)', context)
+    if not match:
+        return None
+    copy_line = int(match.group(1))
+    if 1 <= copy_line <= len(lines):
+        return lines[copy_line - 1]
+    return None
+
+#Upload the CSV in binary_file (any binary file object) into table on connection and commit.
+#create_missing creates the table with TEXT columns when it does not exist yet. The rejects report is written as CSV to
+#rejects_file (a text file object) when it is given.
+def copy_upload(connection, table, binary_file, delimiter=';', create_missing=False, rejects_file=None):
+    if table not in upload_tables:
+        raise UploadError(f"Uploads into {table} are not allowed.")
+    encoding = detect_encoding(binary_file)
+    text = io.TextIOWrapper(binary_file, encoding=encoding, newline='')
+    reader = csv.reader(text, delimiter=delimiter)
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise UploadError("The file is empty.")
+
+    try:
+        with connection.cursor() as cursor:
+            columns = table_columns(cursor, table)
+            if not columns:
+                if not create_missing:
+                    raise UploadError(f"Table {table} does not exist.")
+                create_text_table(cursor, table, header)
+                columns = table_columns(cursor, table)
+            mapped = map_header(header, columns)
+
+            validator = validation.Validator.for_table(cursor, table, mapped, header)
+            report = validation.RejectsReport(rejects_file)
+            rows = _AcceptedRows(reader, validator, report)
+            cursor.execute('SET datestyle = "ISO, DMY";')
+            try:
+                cursor.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH CSV").format(
+                    sql.Identifier(table),
+                    sql.SQL(', ').join(sql.Identifier(name) for name in mapped)
+                ), RowStream(iter(rows)))
+            except UnicodeDecodeError as error:
+                raise UploadError(f"The file is not valid {encoding}: {error}")
+            except psycopg2.DataError as error:
+                line = _failed_line(error, rows.lines)
+                where = f" on line {line}" if line else ''
+                raise UploadError(f"Nothing was inserted, the database rejected the data{where}: {error.pgerror or error}".strip())
+            inserted = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        text.detach()
+    return UploadResult(table, inserted, report)
+
+#Check the CSV in binary_file against table the way copy_upload would, without writing anything.
+#Returns an UploadResult with the rows that would be inserted as inserted.
+def check_upload(connection, table, binary_file, delimiter=';', rejects_file=None):
+    encoding = detect_encoding(binary_file)
+    text = io.TextIOWrapper(binary_file, encoding=encoding, newline='')
+    reader = csv.reader(text, delimiter=delimiter)
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise UploadError("The file is empty.")
+    try:
+        with connection.cursor() as cursor:
+            columns = table_columns(cursor, table)
+            if not columns:
+                raise UploadError(f"Table {table} does not exist.")
+            validator = validation.Validator.for_table(cursor, table, map_header(header, columns), header)
+        connection.rollback()
+        report = validation.RejectsReport(rejects_file)
+        accepted = sum(1 for _ in _AcceptedRows(reader, validator, report))
+    finally:
+        text.detach()
+    return UploadResult(table, accepted, report)
+
+#python upload.py checks the CSV files of Project_Data (or the files given) against the tables of the database in database.ini,
+#so a change to validation.py that would reject the project's own data is noticed. Exits with 1 when a row would be rejected.
+if __name__ == "__main__":
+    import argparse
+    import os
+    import sys
+
+    from config import config
+
+    project_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Project_Data")
+    parser = argparse.ArgumentParser(description="Check CSV files against the validation of the uploads without inserting them.")
+    parser.add_argument('files', nargs='*', default=[os.path.join(project_data, "homicide_news_data.csv")],
+                        help="CSV files to check, by default the homicide_news_data.csv of Project_Data")
+    parser.add_argument('--table', choices=upload_tables, default='homicide_news')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(**config())
+    rejected = 0
+    try:
+        for path in args.files:
+            with open(path, 'rb') as file:
+                result = check_upload(connection, args.table, file)
+            print(f"{path}: {str(result).replace('inserted into', 'accepted by')}")
+            rejected += result.rejected
+    finally:
+        connection.close()
+    sys.exit(1 if rejected else 0)
@@ -0,0 +1,139 @@
+import csv
+import datetime
+import io
+import re
+
+#Load the Excel workbooks in Project_Data straight into a table.
+#The sheet is read in openpyxl's read only mode, which parses it row by row, and the rows are turned into CSV text a few at a time
+#as COPY asks for more data, so neither the whole sheet nor an intermediate CSV file is ever held in memory or written to disk.
+
+#Headers used in the workbooks that do not match a column name once normalised, normalised header -> column
+header_aliases = {
+    'url': 'news_report_url',
+    'headline': 'news_report_headline',
+    'platform': 'news_report_platform',
+    'publication date': 'date_of_publication',
+    'race': 'race_of_victim',
+    'age': 'age_of_victim',
+    'province': 'place_of_death_province',
+    'town': 'place_of_death_town',
+}
+
+#Size of the text handed to COPY at a time
+buffer_size = 64 * 1024
+
+#Lower case a header or column name and keep only its words, so 'LOCATION (Home/PUBLIC/WORK/Unknown)', '"LOCATION (HOME/PUBLIC/WORK/UNKNOWN)"'
+#and 'location_home_public_work_unknown' all compare equal
+def normalise_header(name):
+    return ' '.join(re.findall(r'[a-z0-9]+', str(name).lower()))
+
+#Match the header row of a sheet to the table columns. Returns (position in the row, column) for every header that matches a column.
+def map_headers(headers, columns):
+    by_name = {normalise_header(col): col for col in columns}
+    mapping = []
+    unmatched = []
+    used = set()
+    for position, header in enumerate(headers):
+        if header is None or str(header).strip() == '':
+            continue
+        name = normalise_header(header)
+        column = by_name.get(name)
+        if column is None and name in header_aliases:
+            column = by_name.get(normalise_header(header_aliases[name]))
+        if column is None or column in used:
+            unmatched.append(str(header))
+            continue
+        used.add(column)
+        mapping.append((position, column))
+    if unmatched:
+        print(f"Ignoring workbook columns that do not match the table: {', '.join(unmatched)}")
+    if not mapping:
+        raise ValueError("None of the workbook headers match the table columns.")
+    return mapping
+
+#Text COPY understands for one cell. Whole numbers stored as floats lose their '.0' so they fit INT columns,
+#dates are written as ISO dates and empty cells become NULL.
+def cell_text(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time(0, 0):
+            return value.date().isoformat()
+        return value.isoformat(sep=' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, bool):
+        return 'Y' if value else 'N'
+    text = str(value)
+    return text if text.strip() != '' else None
+
+#File object producing CSV text from an iterator of rows, only ever holding about buffer_size characters
+class RowStream:
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = ''
+        self.rows_written = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = buffer_size
+        while len(self.pending) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.rows_written += 1
+            if self.buffer.tell() >= buffer_size:
+                self.pending += self.buffer.getvalue()
+                self.buffer.seek(0)
+                self.buffer.truncate()
+        if len(self.pending) < size:
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+#Rows of the sheet as lists of COPY text in column order, skipping the rows before the header and the empty rows
+def _sheet_rows(worksheet, columns):
+    rows = worksheet.iter_rows(values_only=True)
+    for headers in rows:
+        if any(cell is not None and str(cell).strip() != '' for cell in headers):
+            break
+    else:
+        raise ValueError("The sheet is empty.")
+    mapping = map_headers(headers, columns)
+    mapped_columns = [column for _, column in mapping]
+    yield mapped_columns
+    for row in rows:
+        values = [cell_text(row[position]) if position < len(row) else None for position, _ in mapping]
+        if any(value is not None for value in values):
+            yield values
+
+def is_workbook(file_path):
+    return file_path.lower().endswith(('.xlsx', '.xlsm'))
+
+#COPY one sheet of a workbook into table. columns are the columns of the table the sheet may fill (as written in the COPY column list),
+#sheet is the name of the sheet to read, the first sheet is used when it is not given. Returns the number of rows copied.
+def copy_from_xlsx(cursor, table, columns, xlsx_file_path, sheet=None):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(xlsx_file_path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        rows = _sheet_rows(worksheet, columns)
+        mapped_columns = next(rows)
+        stream = RowStream(rows)
+        cursor.execute('SET datestyle = "ISO, DMY";')
+        cursor.copy_expert(f"COPY {table} ({', '.join(mapped_columns)}) FROM STDIN WITH CSV", stream)
+        print(f"Data copied successfully to {table} from sheet '{worksheet.title}': {stream.rows_written} rows.")
+        return stream.rows_written
+    finally:
+        workbook.close()